@@ -31,6 +31,28 @@ def load(exec_path):
 
     return options
 
+def convert(options, name, cast, default):
+    value = getattr(options, name)
+    if value == None or value == '':
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        return default
+
+def getInt(options, name, default=0):
+    return convert(options, name, int, default)
+
+def getFloat(options, name, default=0.0):
+    return convert(options, name, float, default)
+
+def getBool(options, name, default=False):
+    def cast(value):
+        if type(value) == bool:
+            return value
+        return str(value).lower() in ('1', 'yes', 'true', 'on')
+    return convert(options, name, cast, default)
+
 def normalize(options, exec_dir, exec_name):
     if not options.base_dir:
         options.base_dir = exec_dir
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import SocketServer
+import logging
+
+log = logging.getLogger(__name__)
+
+# Response of failed query, client answers it locally instead
+ERROR_MARKER = '\0guide-daemon-error\n'
+
+
+##
+# Response is JSON header line with diagnostics of query followed by its
+# output, so client can tell them apart
+##
+def formatResponse(output, errors):
+    return json.dumps({'errors': errors.decode('utf-8')}) + '\n' + output
+
+def parseResponse(response):
+    header, output = response.split('\n', 1)
+    return output, json.loads(header)['errors'].encode('utf-8')
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            log.warn('Malformed daemon request')
+            return
+
+        start = time.time()
+        try:
+            response = formatResponse(*self.server.handler(request.get('argv', [])))
+        except Exception:
+            log.exception('Daemon failed to answer %s', request.get('argv'))
+            response = ERROR_MARKER
+        log.debug('Answered %s in %.2f ms', request.get('argv'), (time.time() - start) * 1000)
+        self.wfile.write(response)
+
+
+class GuideServer(SocketServer.UnixStreamServer):
+
+    def __init__(self, socketPath, handler):
+        self.handler = handler
+        SocketServer.UnixStreamServer.__init__(self, socketPath, RequestHandler)
+
+
+def isRunning(socketPath):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+##
+# Serve handler(argv) results, (output, errors) pair, over Unix socket.
+# Requests are answered one by one while refresh() runs periodically in
+# background thread.
+##
+def serve(socketPath, handler, refresh=None, interval=0):
+    if os.path.exists(socketPath):
+        if isRunning(socketPath):
+            log.error('Guide daemon already running: %s', socketPath)
+            return False
+        os.remove(socketPath)
+
+    def refreshLoop():
+        while True:
+            try:
+                refresh()
+            except Exception as e:
+                log.error('Daemon refresh failed: %s', e)
+            if interval <= 0:
+                return
+            time.sleep(interval)
+
+    if refresh:
+        thread = threading.Thread(target=refreshLoop, name='refresh')
+        thread.daemon = True
+        thread.start()
+
+    # Termination unwinds serve loop, so socket file gets removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = GuideServer(socketPath, handler)
+    log.info('Guide daemon listening: %s', socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketPath)
+    return True
+
+##
+# Send query to running daemon, returns (output, errors) pair, None when
+# daemon is not available or failed to answer
+##
+def request(socketPath, argv, timeout=30):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketPath)
+        sock.sendall(json.dumps({'argv': argv}) + '\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        response = ''.join(chunks)
+        if response == ERROR_MARKER:
+            log.warn('Guide daemon failed to answer query, answering locally')
+            return None
+        return parseResponse(response)
+    except socket.error as e:
+        log.debug('Guide daemon not available: %s', e)
+        return None
+    except (ValueError, KeyError):
+        log.warn('Malformed guide daemon response, answering locally')
+        return None
+    finally:
+        sock.close()
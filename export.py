@@ -0,0 +1,140 @@
+import time
+import json
+import logging
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+import render
+import schedule
+
+log = logging.getLogger(__name__)
+
+quote = json.encoder.encode_basestring_ascii
+
+##
+# Local UTC offset of time, eg. +0300, DST of the very moment is respected
+##
+def formatOffset(moment):
+    stamp = time.mktime(moment.timetuple())
+    if time.localtime(stamp).tm_isdst:
+        offset = time.altzone
+    else:
+        offset = time.timezone
+    sign = offset <= 0 and '+' or '-'
+    offset = abs(offset) // 60
+    return '%s%02d%02d' % (sign, offset // 60, offset % 60)
+
+
+##
+# Shows written out in chunks the same way query results are rendered,
+# fields are fixed by export format
+##
+class Exporter(render.Renderer):
+
+    def __init__(self, output):
+        render.Renderer.__init__(self, output)
+        self.hours = {}
+
+    ##
+    # Format show start/end minutes counted from schedule day midnight.
+    # Hour part with UTC offset is formatted once, minutes filled in.
+    ##
+    def formatMoment(self, day, minutes):
+        key = (day, minutes // 60)
+        hour = self.hours.get(key)
+        if hour == None:
+            moment = day + datetime.timedelta(hours=minutes // 60)
+            hour = self.hours[key] = self.formatHour(moment, formatOffset(moment))
+        return hour % (minutes % 60)
+
+    def formatHour(self, moment, offset):
+        pass
+
+    def begin(self, channels):
+        pass
+
+    def show(self, channel, day, show):
+        pass
+
+
+class XmltvExporter(Exporter):
+
+    def begin(self, channels):
+        self.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
+        self.write(u'<tv generator-info-name="tvguide">\n')
+        for channel in channels:
+            self.write(u'  <channel id=%s>\n    <display-name>%s</display-name>\n  </channel>\n'
+                       % (quoteattr(channel['name']), escape(channel['label'])))
+
+    def formatHour(self, moment, offset):
+        return moment.strftime('%Y%m%d%H') + '%02d00 ' + offset
+
+    def show(self, channel, day, show):
+        parts = [u'  <programme start="%s" stop="%s" channel=%s>\n    <title>%s</title>\n'
+                 % (self.formatMoment(day, show['start']), self.formatMoment(day, show['end']),
+                    quoteattr(channel['name']), escape(show['title'] or u''))]
+        if show.get('description'):
+            parts.append(u'    <desc>%s</desc>\n' % escape(show['description']))
+        parts.append(u'  </programme>\n')
+        self.write(u''.join(parts))
+
+    def end(self):
+        self.write(u'</tv>\n')
+        render.Renderer.end(self)
+
+
+class JsonLinesExporter(Exporter):
+
+    def formatHour(self, moment, offset):
+        return moment.strftime('%Y-%m-%dT%H:') + '%02d:00' + offset[:3] + ':' + offset[3:]
+
+    ##
+    # Records are put together from strings escaped by C JSON encoder,
+    # same output as json.dumps(record, sort_keys=True) only faster
+    ##
+    def show(self, channel, day, show):
+        # Missing text is empty string, same as --format json of queries
+        self.write('{"channel": %s, "description": %s, "label": %s, "start": "%s", "stop": "%s", "title": %s}\n' % (
+            quote(channel['name']), quote(show.get('description') or u''), quote(channel['label']),
+            self.formatMoment(day, show['start']), self.formatMoment(day, show['end']), quote(show['title'] or u'')))
+
+
+EXPORT_FORMATS = {
+    'xmltv': XmltvExporter,
+    'jsonl': JsonLinesExporter,
+}
+
+##
+# Stream stored schedules of channels, one channel day in memory at once.
+# Stored days are exported when no date range is given. Nothing is
+# harvested, run --prefetch first to export days ahead.
+##
+def export(store, output, exportFormat, names=None, dateFrom=None, dateTo=None):
+    catalog = store.getChannelCatalog()
+    if not catalog:
+        log.warn('No channels list available')
+        return 0
+    channels = [catalog.byName[name] for name in catalog.resolve(names)]
+
+    exporter = EXPORT_FORMATS[exportFormat](output)
+    exporter.begin(channels)
+    count = 0
+    for channel in channels:
+        if dateFrom != None or dateTo != None:
+            first = dateFrom or dateTo
+            days = [first + datetime.timedelta(days=offset) for offset in range(((dateTo or first) - first).days + 1)]
+        else:
+            days = sorted(store.listChannelSchedules(channel['name']))
+        for date in days:
+            shows = store.readChannelSchedule(channel['name'], date)
+            if not shows:
+                continue
+            if 'start' not in shows[0]:
+                schedule.normalizeShows(shows)
+            day = datetime.datetime(date.year, date.month, date.day)
+            for show in shows:
+                exporter.show(channel, day, show)
+            count += len(shows)
+    exporter.end()
+    log.info('Exported %s shows of %s channels', count, len(channels))
+    return count
@@ -1,41 +1,60 @@
 #!/usr/bin/env python2
 
 # Vendor modules
+import os
 import re
 import sys
-import inspect
 import argparse
 import datetime
+import StringIO
 # Local modules
 import config
+import logs
+import metrics
+import render
+import storage
+import schedule
 import tvfetch
 import tvselect
 
 
-EXEC_PATH = inspect.getframeinfo(inspect.currentframe()).filename
+EXEC_PATH = os.path.abspath(__file__)
 
 def now(days=0):
     delta = datetime.timedelta(days=days)
     return datetime.datetime.now() + delta
 
+# Output and diagnostics streams, replaced with request buffers when
+# serving daemon clients. Diagnostics never mix into machine readable
+# output formats.
+OUTPUT = sys.stdout
+ERRORS = sys.stderr
+
 def out(fmt, *args):
     msg = str(fmt) % args
     msg = '%s\n' % msg
-    sys.stdout.write(msg.encode('utf-8'))
+    OUTPUT.write(msg.encode('utf-8'))
 
 def err(fmt, *args):
     msg = str(fmt) % args
     msg = '%s\n' % msg
-    sys.stdout.write(msg.encode('utf-8'))
+    ERRORS.write(msg.encode('utf-8'))
 
 def printAll(items):
     for item in items:
         out(item)
     err(len(items))
 
-def printDict(dataDict):
+# Columns of shows in machine readable formats
+SHOW_COLUMNS = ('date', 'start', 'end', 'live', 'channel', 'label', 'title', 'description')
+
+def printDict(dataDict, columns, renderFormat='text'):
+    width = max([len(key) for key in dataDict.keys()] or [0])
+    renderer = render.create(renderFormat, OUTPUT, columns, u'%%(%s)%ds | %%(%s)s' % (columns[0], width, columns[1]))
+    renderer.begin()
     for key, value in dataDict.items():
-        out('%30s | %s', key, value)
+        renderer.row({columns[0]: key, columns[1]: value})
+    renderer.end()
 
 class DateType(object):
 
@@ -85,11 +104,22 @@ class TimeType(object):
     def __repr__(self):
         return 'time'
 
-def main():
+def createParser():
     parser = argparse.ArgumentParser(description='TV Guide harvest tool')
     group_action = parser.add_mutually_exclusive_group()
     group_action.add_argument('-c', '--channels', action='store_true', help='List available TV guide channels')
     group_action.add_argument('-g', '--groups', action='store_true', help='List available TV guide channel categories')
+    group_action.add_argument('--migrate', action='store_true', help='Import JSON schedules into configured storage backend or STORAGE_FORMAT')
+    group_action.add_argument('--reindex', action='store_true', help='Rebuild show search index from stored schedules')
+    group_action.add_argument('--serve', action='store_true', help='Run resident guide daemon answering queries over local socket')
+    group_action.add_argument('--expire', action='store', type=int, nargs='?', const=0, metavar='DAYS', help='Expire schedules older than DAYS days (default STORAGE_DECAY)')
+    group_action.add_argument('--export', action='store', choices=['xmltv', 'jsonl'], help='Export stored schedules of channels (all by default) in XMLTV or JSON lines format')
+    group_action.add_argument('--prefetch', action='store', type=int, nargs='?', const=0, metavar='DAYS', help='Harvest missing schedules of next DAYS days')
+    parser.add_argument('--local', action='store_true', help='Do not use running guide daemon')
+    parser.add_argument('--ordered', action='store_true', help='Sort shows of all channels by date and time')
+    parser.add_argument('--format', action='store', default='text', choices=['text', 'json', 'csv', 'tsv'], help='Output format of channels, categories and shows')
+    parser.add_argument('--profile', action='store', nargs='?', const='table', choices=['table', 'json'], help='Report phase timings and cache counters to stderr')
+    parser.add_argument('--profile-dump', action='store', metavar='FILE', help='Save cProfile stats of the run to FILE')
     group_channels = group_action.add_argument_group(title='Schedule', description='Show channels schedule')
     group_channels.add_argument('name', metavar='CHANNEL|CATEGORY', action='store', type=str, help='Channel/Category name', nargs='*')
     group_channels.add_argument('-s', '--show', action='store', type=str, help='Show to select')
@@ -103,20 +133,144 @@ def main():
     group_time_range = group_date.add_argument_group()
     group_time_range.add_argument('--time-from', action='store', type=TimeType(), help='Start time to select')
     group_time_range.add_argument('--time-to', action='store', type=TimeType(), help='End time to select')
-    args = parser.parse_args()
+    return parser
+
+def getSocketPath(options):
+    return options.socket or os.path.join(options.cache_dir, 'guide.sock')
+
+##
+# Keep today schedules of all channels warm in daemon memory
+##
+def refresh(store):
+    import harvest
+    if store.params.prefetch_days:
+        import prefetch
+        prefetch.Prefetcher(store).run()
+
+    today = datetime.date.today()
+    store.dropShowsCache(today - datetime.timedelta(days=1))
+    catalog = store.getChannelCatalog()
+    if not catalog:
+        return
+    pool = harvest.WorkerPool(config.getInt(store.params, 'workers', 1))
+    pool.map(lambda channel: store.getChannelShows(channel['name'], today), catalog.channels)
+
+def serve(options):
+    import daemon
+    store = tvfetch.ChannelStore(options)
+    store.enableShowsCache()
+    guide = tvselect.ShowSelect(store)
+    parser = createParser()
+
+    def handle(argv):
+        global OUTPUT, ERRORS
+        output = OUTPUT = StringIO.StringIO()
+        errors = ERRORS = StringIO.StringIO()
+        try:
+            query(parser.parse_args(argv), store, guide)
+        except SystemExit:
+            pass
+        finally:
+            OUTPUT = sys.stdout
+            ERRORS = sys.stderr
+        return output.getvalue(), errors.getvalue()
+
+    interval = config.getInt(options, 'refresh_interval', 900)
+    daemon.serve(getSocketPath(options), handle, lambda: refresh(store), interval)
+
+##
+# Run with metrics collected, query is answered locally to be measured
+##
+def profile(args, options):
+    metrics.enable()
+    args.local = True
+    if args.profile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(run, args, options)
+        profiler.dump_stats(args.profile_dump)
+    else:
+        run(args, options)
+    OUTPUT.flush()
+
+    data = metrics.report()
+    if args.profile == 'json':
+        import json
+        sys.stderr.write(json.dumps(data, indent=2, sort_keys=True) + '\n')
+    elif args.profile:
+        sys.stderr.write('\n'.join(metrics.formatReport(data)) + '\n')
+
+def main():
+    args = createParser().parse_args()
 
     options = config.load(EXEC_PATH)
+    logs.setup(options)
+
+    if args.profile or args.profile_dump:
+        profile(args, options)
+    else:
+        run(args, options)
+
+def run(args, options):
+    if args.serve:
+        serve(options)
+        return
+
+    queryAction = not args.migrate and not args.reindex and not args.export and args.expire == None and args.prefetch == None
+    if queryAction and not args.local and os.path.exists(getSocketPath(options)):
+        import daemon
+        response = daemon.request(getSocketPath(options), sys.argv[1:])
+        if response != None:
+            output, errors = response
+            ERRORS.write(errors)
+            OUTPUT.write(output)
+            return
+
+    if args.migrate:
+        err('Migrated schedules: %s', storage.migrate(options))
+        return
+
     store = tvfetch.ChannelStore(options)
+
+    if args.reindex:
+        index = store.getShowIndex()
+        if not index:
+            err('Show search index is disabled')
+        else:
+            err('Indexed schedules: %s', index.rebuild(store.storage, store.history))
+        return
+
+    if args.expire != None:
+        err('Expired schedules: %s', store.expireSchedules(args.expire))
+        return
+
+    if args.export:
+        import export
+        count = export.export(store, OUTPUT, args.export, args.name, args.date_from or args.date, args.date_to or args.date)
+        sys.stderr.write('Exported shows: %s\n' % count)
+        return
+
+    if args.prefetch != None:
+        import prefetch
+        queue = prefetch.Prefetcher(store, args.prefetch).run()
+        if queue:
+            err('Prefetched schedules: %s, failed: %s', queue['done'], len(queue['failed']))
+        else:
+            err('Prefetch skipped, LOCAL_ONLY is set')
+        return
+
     guide = tvselect.ShowSelect(store)
+    query(args, store, guide)
 
+def query(args, store, guide):
     channelMap = tvselect.getChannelsMap(store)
     categoryMap = tvselect.getCategoriesMap(store)
 
     if args.channels:
-        printDict(channelMap)
+        printDict(channelMap, ('channel', 'label'), args.format)
         return
     if args.groups:
-        printDict(categoryMap)
+        printDict(categoryMap, ('group', 'category'), args.format)
         return
 
     targetName = []
@@ -139,28 +293,63 @@ def main():
     if len(targetGroup) == 0:
         targetGroup = None
 
+    if targetName or targetGroup:
+        import prefetch
+        catalog = store.getChannelCatalog()
+        prefetch.QueryStats(store.params).record(catalog.resolve(targetName or targetGroup))
+
     if args.date == None and args.date_from == None and args.date_to == None:
         args.date = datetime.datetime.now().date()
     if not targetName:
         if args.time == None and args.time_from == None and args.time_to == None:
             args.time = datetime.datetime.now().time()
 
-    selected = guide.select(targetName, targetGroup, args.show, args.date, args.date_from, args.date_to, args.time, args.time_from, args.time_to)
+    selected = guide.iterate(targetName, targetGroup, args.show, args.date, args.date_from, args.date_to, args.time, args.time_from, args.time_to,
+                             ordered=args.ordered)
     preciseChannel = targetName and len(targetName) == 1
     preciseTime = args.date and args.time
-    for show in selected:
-        if preciseChannel:
-            texts = []
-            if show['title']:
-                texts.append(show['title'])
-            if show['description']:
-                texts.append(show['description'])
-            live = show['live'] and '*' or ' '
-            out('%s%s - %s | %s', live, show['time'], show['ends'], ' -- '.join(texts))
-        elif preciseTime:
-            out('%s - %s | %-25s | %s', show['time'], show['ends'], channelMap[show['channel']], show['title'])
-        else:
-            live = show['live'] and '*' or ' '
-            out('%s%s - %s | %-25s | %s', live, show['time'], show['ends'], channelMap[show['channel']], show['title'])
+    # Label column fits the longest label of channels in result set
+    if targetName:
+        labels = [channelMap[name] for name in targetName]
+    elif targetGroup:
+        labels = [channel['label'] for channel in store.getChannelCatalog().getGroup(targetGroup[0])]
+    else:
+        labels = channelMap.values()
+    width = max([len(label) for label in labels] or [0])
+    if preciseChannel:
+        layout = u'%(marker)s%(start)s - %(end)s | %(texts)s'
+    elif preciseTime:
+        layout = u'%%(start)s - %%(end)s | %%(label)-%ds | %%(title)s' % width
+    else:
+        layout = u'%%(marker)s%%(start)s - %%(end)s | %%(label)-%ds | %%(title)s' % width
+    text = args.format == 'text'
+    renderer = render.create(args.format, OUTPUT, SHOW_COLUMNS, layout)
+    renderer.begin()
+
+    nowMinutes = schedule.toMinutes(datetime.datetime.now().time())
+    today = datetime.date.today()
+    lastChannel = None
+    # Timed once for all rows, it includes waiting for select steps too
+    with metrics.timer('render'):
+        for show in metrics.timed('select', selected):
+            if show.channel != lastChannel and not args.ordered:
+                # Shows are printed as channels get harvested
+                renderer.flush()
+                lastChannel = show.channel
+            record = {
+                'date': show.date.strftime('%Y-%m-%d'),
+                'start': show.time,
+                'end': show.ends,
+                'live': show.isLive(today, nowMinutes),
+                'channel': show.channel,
+                'label': channelMap[show.channel],
+                'title': show.title,
+                'description': show.description,
+            }
+            if text:
+                record['marker'] = show.isAiring(nowMinutes) and '*' or ' '
+                record['texts'] = u' -- '.join(filter(None, (show.title, show.description)))
+            renderer.row(record)
+        renderer.end()
 
 main()
@@ -0,0 +1,216 @@
+import time
+import threading
+import Queue as queue
+import logging
+# Imported lazily by first strptime() call, which fails in concurrent threads
+import _strptime
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class WorkerPool:
+
+    def __init__(self, workers=1, name='harvest'):
+        self.workers = max(1, workers)
+        self.name = name
+
+    ##
+    # Apply func to every item using worker threads, results keep items order.
+    # Failed items are logged and produce None, same as a failed harvest.
+    ##
+    def map(self, func, items):
+        return list(self.imap(func, items))
+
+    ##
+    # Same as map, but yields results in items order as soon as they are
+    # ready, so first results can be used while others still run.
+    ##
+    def imap(self, func, items):
+        items = list(items)
+
+        def apply(index, item):
+            try:
+                return func(item)
+            except Exception as e:
+                log.error('Worker failed on %s: %s', item, e)
+
+        if self.workers == 1 or len(items) <= 1:
+            for index, item in enumerate(items):
+                yield apply(index, item)
+            return
+
+        tasks = queue.Queue()
+        for task in enumerate(items):
+            tasks.put(task)
+        done = queue.Queue()
+
+        def worker():
+            while True:
+                try:
+                    index, item = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                done.put((index, apply(index, item)))
+
+        threads = []
+        for number in range(min(self.workers, len(items))):
+            thread = threading.Thread(target=worker, name='%s-%d' % (self.name, number,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        log.debug('Started %s workers for %s items', len(threads), len(items))
+        ready = {}
+        nextIndex = 0
+        while nextIndex < len(items):
+            try:
+                # Get with timeout keeps main thread responsive for Ctrl+C
+                index, result = done.get(True, 0.1)
+            except queue.Empty:
+                continue
+            ready[index] = result
+            while nextIndex in ready:
+                yield ready.pop(nextIndex)
+                nextIndex += 1
+
+
+##
+# Parse processes do not log, forked log queue belongs to parent
+##
+def initParser():
+    logging.getLogger().handlers = [logging.NullHandler()]
+
+##
+# Parse process entry, page is parsed in child process and only plain
+# records are sent back. Errors are returned, pool callbacks see results.
+##
+def parsePage(data, engine):
+    import tvfetch
+    start = time.time()
+    try:
+        return tvfetch.parseSchedulePage(data, engine), None, time.time() - start
+    except Exception as e:
+        return None, str(e), time.time() - start
+
+
+##
+# Harvest in three stages: fetch worker threads download pages, process
+# pool parses them and the calling thread alone writes results to store.
+# Pages waiting for parse and write are bounded by queue size, so fetch
+# workers stop when parsing or writing falls behind.
+##
+class HarvestPipeline:
+
+    def __init__(self, store, fetchWorkers=1, parseProcesses=1, queueSize=None):
+        self.store = store
+        self.fetchWorkers = max(1, fetchWorkers)
+        self.parseProcesses = max(1, parseProcesses)
+        self.queueSize = queueSize or self.parseProcesses * 2
+        self.stats = {}
+
+    def __count(self, stage, elapsed, failed=False):
+        with self.lock:
+            stats = self.stats.setdefault(stage, {'pages': 0, 'failed': 0, 'seconds': 0.0})
+            stats['pages'] += 1
+            stats['failed'] += failed and 1 or 0
+            stats['seconds'] += elapsed
+        metrics.add('pipeline.' + stage, elapsed)
+
+    ##
+    # Harvest (channel, date) pages, onStored(channel, dates) is called by
+    # writer for every stored page. Returns stats of stages.
+    ##
+    def run(self, pages, onStored=None):
+        import multiprocessing
+        self.lock = threading.Lock()
+        self.stats = {}
+        if len(pages) == 0:
+            return self.stats
+
+        engine = self.store.engine
+        tasks = queue.Queue()
+        for page in pages:
+            tasks.put(page)
+        fetched = queue.Queue(self.queueSize)
+        parsed = queue.Queue()
+        slots = threading.Semaphore(self.queueSize)
+
+        # Pool is forked before threads start
+        pool = multiprocessing.Pool(min(self.parseProcesses, len(pages)), initParser)
+
+        def fetcher():
+            while True:
+                try:
+                    channel, date = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    url, data = self.store.fetchSchedulePage(channel, date)
+                except Exception as e:
+                    log.error('Fetch failed on %s (%s): %s', channel, date, e)
+                    url, data = None, None
+                self.__count('fetch', time.time() - start, not data)
+                # Blocks when parse stage lags behind
+                fetched.put(((channel, date), url, data))
+
+        def dispatcher():
+            for i in range(len(pages)):
+                page, url, data = fetched.get()
+                slots.acquire()
+                if not data:
+                    parsed.put((page, url, data, (None, None, 0.0)))
+                    continue
+                def done(result, item=(page, url, data)):
+                    parsed.put(item + (result,))
+                pool.apply_async(parsePage, (data, engine), callback=done)
+
+        threads = []
+        for number in range(min(self.fetchWorkers, len(pages))):
+            threads.append(threading.Thread(target=fetcher, name='fetch-%d' % number))
+        threads.append(threading.Thread(target=dispatcher, name='dispatch'))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        log.debug('Pipeline started: %s fetch workers, %s parse processes, queue %s',
+                  self.fetchWorkers, self.parseProcesses, self.queueSize)
+        started = time.time()
+        try:
+            for i in range(len(pages)):
+                while True:
+                    try:
+                        # Get with timeout keeps main thread responsive for Ctrl+C
+                        (channel, date), url, data, (shedules, error, elapsed) = parsed.get(True, 0.1)
+                        break
+                    except queue.Empty:
+                        continue
+                if data:
+                    self.__count('parse', elapsed, not shedules)
+                if shedules:
+                    start = time.time()
+                    self.store.saveHarvest(channel, shedules)
+                    self.__count('store', time.time() - start)
+                    if onStored:
+                        onStored(channel, [day['date'] for day in shedules])
+                elif data:
+                    log.error('Failed parse: %s %s', url, error or '')
+                    import web
+                    web.getPageArchive(self.store.params).store(url, data, error or 'parse')
+                slots.release()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        wall = time.time() - started
+        for stage in ('fetch', 'parse', 'store'):
+            stats = self.stats.get(stage)
+            if stats:
+                log.info('Pipeline %s: %s pages, %s failed, %.1f pages/s', stage, stats['pages'], stats['failed'],
+                         stats['pages'] / max(wall, 0.001))
+        return self.stats
@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+
+import os
+import sys
+import json
+import time
+import shutil
+import urllib2
+import argparse
+import tempfile
+import subprocess
+import logging
+
+import config
+import metrics
+
+STANDIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin.py')
+
+##
+# Start stand-in site in its own process, so serving does not compete
+# with harvest for the GIL. Returns process and its URL.
+##
+def startStandin(args):
+    command = [sys.executable, STANDIN_PATH, '--port', '0',
+               '--channels', str(args.channels), '--days', str(args.days), '--span', str(args.span),
+               '--shows', str(args.shows), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate), '--rate', str(args.rate), '--burst', str(args.burst)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line.startswith('Serving '):
+        process.kill()
+        raise RuntimeError('Stand-in site failed to start')
+    return process, line.split()[1]
+
+def readStats(url):
+    return json.loads(urllib2.urlopen(url + '/_stats').read())
+
+##
+# Cold harvest of channel list and all channel days into scratch base
+# dir, the same way --prefetch does it
+##
+def harvest(params, days):
+    import tvfetch
+    import prefetch
+    store = tvfetch.ChannelStore(params)
+    catalog = store.getChannelCatalog()
+    if not catalog:
+        return 0, 0
+    queue = prefetch.Prefetcher(store, days).run()
+    return len(catalog.channels), queue['done']
+
+def main():
+    parser = argparse.ArgumentParser(description='TV Guide full harvest benchmark against local stand-in site')
+    parser.add_argument('--url', action='store', help='Running stand-in site URL, started for the run by default')
+    parser.add_argument('-n', '--channels', action='store', type=int, default=20, help='Channels on site')
+    parser.add_argument('-d', '--days', action='store', type=int, default=7, help='Days harvested')
+    parser.add_argument('--span', action='store', type=int, default=3, help='Days covered by one schedule page')
+    parser.add_argument('--shows', action='store', type=int, default=30, help='Shows per channel day')
+    parser.add_argument('--latency', action='store', type=float, default=50, help='Site response delay in milliseconds')
+    parser.add_argument('--jitter', action='store', type=float, default=0, help='Random extra delay up to milliseconds')
+    parser.add_argument('--error-rate', action='store', type=float, default=0.0, help='Fraction of requests answered 500')
+    parser.add_argument('--rate', action='store', type=float, default=0, help='Requests per second site admits (0 unlimited)')
+    parser.add_argument('--burst', action='store', type=int, default=1, help='Requests site admits at once over rate')
+    parser.add_argument('-w', '--workers', action='store', type=int, help='WORKERS of harvest, from settings by default')
+    parser.add_argument('-P', '--parse-processes', action='store', type=int, help='PARSE_PROCESSES of harvest, from settings by default')
+    parser.add_argument('--delay', action='store', type=float, default=0, help='DELAY between requests, 0 does not wait')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log harvest to stderr')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.verbose and logging.INFO or logging.CRITICAL)
+    params = config.load(__file__)
+    process = None
+    url = args.url
+    if not url:
+        process, url = startStandin(args)
+
+    baseDir = tempfile.mkdtemp(prefix='harvestbench-')
+    try:
+        os.chdir(baseDir)
+        for name in ('storage_dir', 'cache_dir', 'archive_dir'):
+            path = os.path.join(baseDir, name.split('_')[0])
+            os.mkdir(path)
+            setattr(params, name, path)
+        params.base_dir = baseDir
+        params.log_dir = None
+        params.local_only = False
+        params.site_url = url
+        params.delay = args.delay
+        if args.workers != None:
+            params.workers = args.workers
+        if args.parse_processes != None:
+            params.parse_processes = args.parse_processes
+
+        metrics.enable()
+        before = readStats(url)
+        start = time.time()
+        channels, stored = harvest(params, args.days)
+        wall = time.time() - start
+        after = readStats(url)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(baseDir)
+        if process:
+            process.terminate()
+            process.wait()
+
+    requests = after['requests'] - before['requests']
+    statuses = dict((status, count - before['statuses'].get(status, 0)) for status, count in after['statuses'].items())
+    print('%s channels x %s days, %s workers, %s parse processes, site latency %s ms' % (
+        args.channels, args.days, config.getInt(params, 'workers', 1), config.getInt(params, 'parse_processes', 0), args.latency))
+    print('%-12s %10.2f s' % ('wall', wall))
+    print('%-12s %10d  %s' % ('requests', requests, ', '.join('%s: %s' % (status, statuses[status])
+                                                               for status in sorted(statuses.keys()) if statuses[status])))
+    print('%-12s %10d' % ('bytes', after['bytes'] - before['bytes']))
+    print('%-12s %10s' % ('stored', '%s/%s' % (stored, channels * args.days)))
+    print('%-12s %10.1f pages/s' % ('throughput', requests / max(wall, 0.001)))
+    print('')
+    for line in metrics.formatReport(metrics.report()):
+        print(line)
+
+    sys.exit(stored < channels * args.days and 1 or 0)
+
+main()
@@ -0,0 +1,71 @@
+import os
+import re
+import logging
+from datetime import datetime
+
+import storage
+
+log = logging.getLogger(__name__)
+
+
+##
+# Expired schedules rolled into compressed bundle per channel month in
+# STORAGE_DIR/history. Bundle maps schedule date to its shows.
+##
+class HistoryArchive:
+
+    BUNDLE_PATTERN = re.compile("^(.+)\-(\d{6})\.json\.gz$")
+
+    def __init__(self, params):
+        self.historyDir = os.path.join(params.storage_dir, 'history')
+        self.format = storage.GzipFormat()
+        # Last read bundle, history queries mostly walk one channel month
+        self.cached = (None, None, None)
+
+    def __getBundle(self, channel, date):
+        return os.path.join(self.historyDir, "%s-%s.json.gz" % (channel, date.strftime("%Y%m")))
+
+    def __readBundle(self, fileName):
+        try:
+            stamp = os.path.getmtime(fileName)
+        except OSError:
+            return None
+        cached = self.cached
+        if cached[:2] != (fileName, stamp):
+            cached = (fileName, stamp, self.format.read(fileName))
+            self.cached = cached
+        return cached[2]
+
+    def hasSchedule(self, channel, date):
+        bundle = self.__readBundle(self.__getBundle(channel, date))
+        return bundle != None and date.strftime('%Y-%m-%d') in bundle
+
+    def readSchedule(self, channel, date):
+        bundle = self.__readBundle(self.__getBundle(channel, date))
+        if bundle == None:
+            return None
+        return bundle.get(date.strftime('%Y-%m-%d'))
+
+    def listAllSchedules(self):
+        if not os.path.isdir(self.historyDir):
+            return
+        for fileName in sorted(os.listdir(self.historyDir)):
+            match = self.BUNDLE_PATTERN.match(fileName)
+            if not match:
+                continue
+            bundle = self.format.read(os.path.join(self.historyDir, fileName)) or {}
+            for dateKey in sorted(bundle.keys()):
+                yield match.group(1), datetime.strptime(dateKey, '%Y-%m-%d').date()
+
+    ##
+    # Merge channel month schedules, {date: shows}, into its bundle
+    ##
+    def saveSchedules(self, channel, month, schedules):
+        if not os.path.isdir(self.historyDir):
+            os.makedirs(self.historyDir)
+        fileName = self.__getBundle(channel, month)
+        bundle = self.format.read(fileName) or {}
+        for date, shows in schedules.items():
+            bundle[date.strftime('%Y-%m-%d')] = shows
+        log.debug('Save %s history bundle %s with %s schedules', channel, fileName, len(bundle))
+        return self.format.write(fileName, bundle)
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+
+import metrics
+from storage import writeAtomic
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry:
+
+    def __init__(self, key, meta, data):
+        self.key = key
+        self.url = meta.get('url')
+        self.etag = meta.get('etag')
+        self.modified = meta.get('modified')
+        self.stored = meta.get('stored', 0)
+        self.size = meta.get('size')
+        self.data = data
+
+    def isFresh(self, ttl):
+        return ttl > 0 and time.time() - self.stored < ttl
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+        return headers
+
+
+class ResponseCache:
+
+    def __init__(self, cacheDir, ttl=3600, maxSize=64 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.size = None
+        self.stats = {
+            'hit': 0,
+            'miss': 0,
+            'revalidated': 0,
+            'stored': 0,
+            'evicted': 0,
+        }
+
+    def __getKey(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def __getMetaFile(self, key):
+        return os.path.join(self.cacheDir, key + '.meta')
+
+    def __getBodyFile(self, key):
+        return os.path.join(self.cacheDir, key + '.body')
+
+    def __count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+        metrics.count('http.cache.' + name)
+
+    def lookup(self, url):
+        key = self.__getKey(url)
+        try:
+            fp = open(self.__getMetaFile(key), 'r')
+            meta = json.load(fp)
+            fp.close()
+            fp = open(self.__getBodyFile(key), 'rb')
+            data = fp.read()
+            fp.close()
+        except (IOError, ValueError):
+            return None
+
+        if meta.get('url') != url:
+            log.debug('Cache key collision for URL: %s', url)
+            return None
+        # Body of other write than meta, entry is not trusted
+        if meta.get('size') != None and meta['size'] != len(data):
+            log.debug('Cache body does not match meta: %s', url)
+            return None
+
+        # Body file mtime is the last use time for LRU eviction
+        try:
+            os.utime(self.__getBodyFile(key), None)
+        except OSError:
+            pass
+
+        return CacheEntry(key, meta, data)
+
+    ##
+    # Return cached body when entry is still within TTL, otherwise None
+    # together with possibly stale entry for revalidation.
+    ##
+    def fresh(self, url):
+        if self.maxSize <= 0:
+            return None, None
+        entry = self.lookup(url)
+        if entry and entry.isFresh(self.ttl):
+            log.debug('Cache hit: %s', url)
+            self.__count('hit')
+            return entry.data, entry
+        return None, entry
+
+    def revalidated(self, entry):
+        log.debug('Cache revalidated: %s', entry.url)
+        self.__count('revalidated')
+        # Body is unchanged, only stored time is renewed
+        self.__writeMeta(entry.key, entry.url, len(entry.data), entry.etag, entry.modified)
+        return entry.data
+
+    def missed(self, url, data, headers):
+        log.debug('Cache miss: %s', url)
+        self.__count('miss')
+        if data:
+            self.store(url, data, headers.get('etag'), headers.get('last-modified'))
+
+    def __writeMeta(self, key, url, size, etag=None, modified=None):
+        meta = {
+            'url': url,
+            'etag': etag,
+            'modified': modified,
+            'stored': time.time(),
+            'size': size,
+        }
+        return writeAtomic(self.__getMetaFile(key), lambda fp: json.dump(meta, fp))
+
+    ##
+    # Body and meta are each replaced atomically, body first, so meta
+    # never describes partially written body
+    ##
+    def store(self, url, data, etag=None, modified=None):
+        if self.maxSize <= 0 or len(data) > self.maxSize:
+            return
+
+        if not os.path.exists(self.cacheDir):
+            os.mkdir(self.cacheDir)
+
+        key = self.__getKey(url)
+        bodyFile = self.__getBodyFile(key)
+        oldSize = os.path.isfile(bodyFile) and os.path.getsize(bodyFile) or 0
+        if not writeAtomic(bodyFile, lambda fp: fp.write(data)):
+            return
+        if not self.__writeMeta(key, url, len(data), etag, modified):
+            return
+
+        self.__count('stored')
+        with self.lock:
+            if self.size != None:
+                self.size += len(data) - oldSize
+        self.evict()
+
+    def __scan(self):
+        entries = []
+        for fileName in os.listdir(self.cacheDir):
+            if not fileName.endswith('.body'):
+                continue
+            stat = os.stat(os.path.join(self.cacheDir, fileName))
+            entries.append((stat.st_mtime, stat.st_size, fileName[:-len('.body')]))
+        return entries
+
+    ##
+    # Drop least recently used entries until cache fits into byte budget
+    ##
+    def evict(self):
+        with self.lock:
+            if self.size == None:
+                self.size = sum(entry[1] for entry in self.__scan())
+            if self.size <= self.maxSize:
+                return
+
+            log.debug('Cache size %s exceeds %s, evicting', self.size, self.maxSize)
+            for used, size, key in sorted(self.__scan()):
+                if self.size <= self.maxSize:
+                    break
+                for fileName in (self.__getBodyFile(key), self.__getMetaFile(key)):
+                    try:
+                        os.remove(fileName)
+                    except OSError:
+                        pass
+                self.size -= size
+                self.stats['evicted'] += 1
+                metrics.count('http.cache.evicted')
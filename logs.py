@@ -0,0 +1,101 @@
+import os
+import atexit
+import threading
+import logging
+import Queue as queue
+
+import config
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warn': logging.WARNING,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+FORMAT = '%(asctime)s %(levelname)-7s %(threadName)s %(name)s: %(message)s'
+
+
+##
+# Records are formatted by calling thread and handed over to listener
+# thread, so file writes and rotation never block harvest or query.
+# Records are dropped when queue is full rather than waiting for disk.
+##
+class QueueHandler(logging.Handler):
+
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Arguments might change before listener gets to them
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.records.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener:
+
+    def __init__(self, records, handler):
+        self.records = records
+        self.handler = handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='logs')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record == None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.records.put(None)
+        self.thread.join(5)
+        self.thread = None
+        self.handler.close()
+
+
+##
+# Configure root logger from LOG_LEVEL. With LOG_DIR set records go to
+# exec name log file rotated at midnight, LOG_DECAY rotated files kept.
+##
+def setup(params, queueSize=10000):
+    root = logging.getLogger()
+    root.setLevel(LEVELS.get((params.log_level or 'warning').lower(), logging.WARNING))
+    if not params.log_dir:
+        root.addHandler(logging.NullHandler())
+        return None
+
+    from logging.handlers import TimedRotatingFileHandler
+    name = os.path.splitext(params.exec_name or 'guide')[0]
+    handler = TimedRotatingFileHandler(os.path.join(params.log_dir, name + '.log'), when='midnight',
+                                       backupCount=max(0, config.getInt(params, 'log_decay', 0)), delay=True)
+    handler.setFormatter(logging.Formatter(FORMAT))
+
+    records = queue.Queue(queueSize)
+    listener = QueueListener(records, handler)
+    listener.start()
+    root.addHandler(QueueHandler(records))
+    atexit.register(listener.stop)
+    return listener
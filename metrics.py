@@ -0,0 +1,100 @@
+import time
+import threading
+import contextlib
+
+##
+# Run phase timers and counters reported by --profile. Collection is off
+# by default, so instrumented code pays only for the enabled check and
+# shared no-op timer.
+# Timers of harvest workers add up, their total may exceed wall time.
+##
+ENABLED = False
+STARTED = None
+TIMERS = {}
+COUNTERS = {}
+LOCK = threading.Lock()
+
+def enable():
+    global ENABLED, STARTED
+    ENABLED = True
+    STARTED = time.time()
+
+def add(name, seconds):
+    if not ENABLED:
+        return
+    with LOCK:
+        timer = TIMERS.get(name)
+        if not timer:
+            timer = TIMERS[name] = [0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+class NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+NULL_TIMER = NullTimer()
+
+def timer(name):
+    if not ENABLED:
+        return NULL_TIMER
+    return timedBlock(name)
+
+@contextlib.contextmanager
+def timedBlock(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        add(name, time.time() - start)
+
+##
+# Iterate items timing every step, eg. lazily generated results
+##
+def timed(name, items):
+    if not ENABLED:
+        return iter(items)
+    return timedItems(name, iter(items))
+
+def timedItems(name, items):
+    while True:
+        start = time.time()
+        try:
+            item = next(items)
+        except StopIteration:
+            add(name, time.time() - start)
+            return
+        add(name, time.time() - start)
+        yield item
+
+def report():
+    with LOCK:
+        return {
+            'wall_ms': STARTED and round((time.time() - STARTED) * 1000, 3),
+            'timers': dict((name, {'count': timer[0], 'total_ms': round(timer[1] * 1000, 3)})
+                           for name, timer in TIMERS.items()),
+            'counters': dict(COUNTERS),
+        }
+
+def formatReport(data):
+    lines = ['%-20s %8s %12s %10s' % ('phase', 'count', 'total ms', 'avg ms')]
+    for name in sorted(data['timers'].keys()):
+        timer = data['timers'][name]
+        lines.append('%-20s %8d %12.1f %10.2f' % (name, timer['count'], timer['total_ms'], timer['total_ms'] / max(1, timer['count'])))
+    lines.append('%-20s %8s %12.1f' % ('wall', '', data['wall_ms'] or 0))
+    if data['counters']:
+        lines.append('')
+        lines.append('%-20s %8s' % ('counter', 'value'))
+        for name in sorted(data['counters'].keys()):
+            lines.append('%-20s %8d' % (name, data['counters'][name]))
+    return lines
@@ -0,0 +1,93 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+
+from storage import readJson, writeJson, writeAtomic
+
+log = logging.getLogger(__name__)
+
+
+##
+# Failed pages kept for inspection and as parser test corpus. Pages are
+# stored gzip compressed under content hash, so the same broken layout
+# is stored once. Index keeps every page failures (URL, date, error).
+##
+class PageArchive:
+
+    # Most recent failures kept in index per page
+    FAILURES = 20
+
+    def __init__(self, archiveDir, maxSize=32 * 1024 * 1024):
+        self.archiveDir = archiveDir
+        self.maxSize = maxSize
+        self.indexFile = os.path.join(archiveDir, 'index.json')
+        self.lock = threading.Lock()
+
+    def __getPageFile(self, key):
+        return os.path.join(self.archiveDir, key + '.html.gz')
+
+    def __readIndex(self):
+        return readJson(self.indexFile) or {}
+
+    def store(self, url, data, error=None):
+        if self.maxSize <= 0:
+            return None
+        if not data:
+            log.debug('Nothing to archive for: %s', url)
+            return None
+
+        key = hashlib.sha1(data).hexdigest()
+        pageFile = self.__getPageFile(key)
+        with self.lock:
+            if not os.path.exists(self.archiveDir):
+                os.mkdir(self.archiveDir)
+
+            index = self.__readIndex()
+            page = index.get(key)
+            if page == None or not os.path.isfile(pageFile):
+                import gzip
+                def writer(fp):
+                    zp = gzip.GzipFile(fileobj=fp, mode='wb', mtime=0)
+                    zp.write(data)
+                    zp.close()
+                if not writeAtomic(pageFile, writer):
+                    return None
+                page = {'size': os.path.getsize(pageFile), 'bytes': len(data), 'failures': []}
+                if page['size'] > self.maxSize:
+                    log.warn('Page %s does not fit into archive budget', url)
+                    os.remove(pageFile)
+                    return None
+                index[key] = page
+                log.info('Page archived for inspection in: %s', os.path.basename(pageFile))
+            else:
+                log.debug('Page already archived in: %s', os.path.basename(pageFile))
+
+            page['used'] = time.time()
+            page['failures'].append({
+                'url': url,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'error': error,
+            })
+            del page['failures'][:-self.FAILURES]
+            self.__evict(index)
+            writeJson(self.indexFile, index)
+        return key in index and pageFile or None
+
+    ##
+    # Drop pages failed longest ago until archive fits into byte budget
+    ##
+    def __evict(self, index):
+        size = sum(page['size'] for page in index.values())
+        if size <= self.maxSize:
+            return
+        log.debug('Archive size %s exceeds %s, evicting', size, self.maxSize)
+        for key in sorted(index.keys(), key=lambda key: index[key]['used']):
+            if size <= self.maxSize:
+                break
+            try:
+                os.remove(self.__getPageFile(key))
+            except OSError:
+                pass
+            size -= index.pop(key)['size']
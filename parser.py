@@ -1,33 +1,200 @@
 #!/usr/bin/env python2
 
+import os
+import sys
+import json
+import time
 import argparse
+import resource
+from datetime import datetime
 
 import tvfetch
 
+def parse(data, channel, engine):
+    if channel:
+        return tvfetch.parseChannels(data, False, engine)
+    else:
+        return tvfetch.parseSchedule(data, False, engine)
+
+class PageTypeError(Exception):
+    pass
+
+##
+# Page type from its structure: every page carries the channels search
+# form, only schedule pages have show items. Pages with neither need
+# explicit -c/-p.
+##
+def isChannelPage(data, fileName, args):
+    if args.channel or args.programme:
+        return args.channel
+    html = tvfetch.ensureSoup(data)
+    if html.select('.channel .item'):
+        return False
+    if html.select('#topsearch_form'):
+        return True
+    raise PageTypeError("Can not tell page type of '%s', use -c or -p" % fileName)
+
+def countRecords(parsed, channel):
+    if channel:
+        return len(parsed)
+    return sum(len(day['shows']) for day in parsed)
+
+def normalize(parsed, channel):
+    # Schedule dates get current year prepended, strip it for stable output
+    if channel:
+        return parsed
+    year = '%s-' % datetime.now().year
+    for day in parsed:
+        day['date'] = day['date'].replace(year, '', 1)
+        for show in day['shows']:
+            show['date'] = show['date'].replace(year, '', 1)
+    return parsed
+
+def listSources(sources):
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for fileName in sorted(os.listdir(source)):
+                path = os.path.join(source, fileName)
+                # Archive index is not a page
+                if os.path.isfile(path) and not fileName.endswith('.json'):
+                    files.append(path)
+        else:
+            files.append(source)
+    return files
+
+def readSource(fileName):
+    if fileName.endswith('.gz'):
+        import gzip
+        fp = gzip.open(fileName, 'rb')
+    else:
+        fp = open(fileName, 'r')
+    data = fp.read()
+    fp.close()
+    return data
+
+def peakMemory():
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchmark(files, args):
+    print('%-40s %6s %8s %9s %9s %8s' % ('page', 'type', 'KB', 'records', 'ms/parse', 'peak KB'))
+    totalBytes = 0
+    totalRecords = 0
+    totalTime = 0.0
+    failed = 0
+    for fileName in files:
+        data = readSource(fileName)
+        channel = isChannelPage(data, fileName, args)
+        try:
+            start = time.time()
+            for i in range(args.bench):
+                parsed = parse(data, channel, args.engine)
+            elapsed = time.time() - start
+        except Exception as e:
+            print('%-40s failed: %s' % (os.path.basename(fileName)[-40:], e))
+            failed += 1
+            continue
+
+        records = countRecords(parsed, channel)
+        totalBytes += len(data) * args.bench
+        totalRecords += records * args.bench
+        totalTime += elapsed
+        print('%-40s %6s %8.1f %9d %9.2f %8d' % (os.path.basename(fileName)[-40:], channel and 'chan' or 'prog',
+                                                 len(data) / 1024.0, records, elapsed * 1000 / args.bench, peakMemory()))
+
+    if totalTime > 0:
+        print('')
+        print('engine %s, %s pages x %s runs, %s failed' % (args.engine, len(files) - failed, args.bench, failed))
+        print('%.2f MB/s, %.0f records/s, %.2f ms/page, peak %d KB' % (totalBytes / totalTime / 1024 / 1024, totalRecords / totalTime,
+                                                                     totalTime * 1000 / ((len(files) - failed) * args.bench), peakMemory()))
+    return failed == 0
+
+def golden(files, args):
+    results = {}
+    for fileName in files:
+        data = readSource(fileName)
+        channel = isChannelPage(data, fileName, args)
+        try:
+            parsed = normalize(parse(data, channel, args.engine), channel)
+        except Exception as e:
+            parsed = {'error': str(e)}
+        results[os.path.basename(fileName)] = parsed
+
+    if args.update_golden:
+        fp = open(args.golden, 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+        print('Stored golden output of %s pages: %s' % (len(results), args.golden))
+        return True
+
+    try:
+        fp = open(args.golden, 'r')
+        expected = json.load(fp)
+        fp.close()
+    except IOError:
+        print("No golden output '%s', create it with --update-golden" % args.golden)
+        return False
+
+    changed = 0
+    for name, parsed in sorted(results.items()):
+        if name not in expected:
+            print('%-40s MISSING' % name[-40:])
+            changed += 1
+        elif expected[name] != json.loads(json.dumps(parsed)):
+            print('%-40s CHANGED' % name[-40:])
+            changed += 1
+    print('%s pages checked, %s changed' % (len(results), changed))
+    return changed == 0
+
+def printPages(files, args):
+    for fileName in files:
+        data = readSource(fileName)
+
+        if args.verify:
+            channel = isChannelPage(data, fileName, args)
+            expected = parse(data, channel, 'soup')
+            for engine in tvfetch.PARSER_ENGINES:
+                same = parse(data, channel, engine) == expected
+                print('%-40s %-8s %s' % (os.path.basename(fileName)[-40:], engine, same and 'OK' or 'DIFFERS'))
+            continue
+
+        if args.channel:
+            parsed = parse(data, True, args.engine)
+            for channel in parsed:
+                print(channel)
+        elif args.programme:
+            parsed = parse(data, False, args.engine)
+            for data in parsed:
+                print(data['date'])
+                for show in data['shows']:
+                    print(show)
+
 def main():
-    parser = argparse.ArgumentParser(description='TV Guide debug parser')
-    parser.add_argument('source', metavar='FILE', action='store', type=str, help='File to parse')
+    parser = argparse.ArgumentParser(description='TV Guide debug parser and benchmark')
+    parser.add_argument('source', metavar='FILE|DIR', action='store', type=str, nargs='+', help='File or directory of saved pages to parse')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-c', '--channel', action='store_true', help='Parse channels list')
     group.add_argument('-p', '--programme', action='store_true', help='Parse programme data')
+    parser.add_argument('-e', '--engine', action='store', choices=tvfetch.PARSER_ENGINES, default='soup', help='Parser engine')
+    parser.add_argument('--verify', action='store_true', help='Check all parser engines produce identical output')
+    parser.add_argument('-b', '--bench', action='store', type=int, metavar='RUNS', help='Benchmark parsing, repeat each page RUNS times')
+    parser.add_argument('--golden', action='store', metavar='FILE', help='Compare parsed records with golden output FILE')
+    parser.add_argument('--update-golden', action='store_true', help='Store parsed records as golden output')
     args = parser.parse_args()
 
+    files = listSources(args.source)
+    for fileName in files:
+        if not os.path.isfile(fileName):
+            parser.error("No such file '%s'" % fileName)
+
     try:
-        fp = open(args.source, 'r')
-        data = fp.read()
-        fp.close()
-    except IOError:
-        parser.error("No such file '%s'" % args.source)
-
-    if args.channel:
-        parsed = tvfetch.parseChannels(data, False)
-        for channel in parsed:
-            print(channel)
-    elif args.programme:
-        parsed = tvfetch.parseSchedule(data, False)
-        for data in parsed:
-            print(data['date'])
-            for show in data['shows']:
-                print(show)
+        if args.bench:
+            sys.exit(not benchmark(files, args))
+        if args.golden:
+            sys.exit(not golden(files, args))
+        printPages(files, args)
+    except PageTypeError as e:
+        parser.error(str(e))
 
 main()
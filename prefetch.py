@@ -0,0 +1,215 @@
+import os
+import threading
+import collections
+import logging
+import datetime
+
+import config
+import harvest
+from storage import readJson, writeJson
+
+log = logging.getLogger(__name__)
+
+
+##
+# Queries append their channels to log, a line per query, so query path
+# never reads and rewrites counts. Planner folds log into counts file.
+##
+class QueryStats:
+
+    def __init__(self, params):
+        self.statsFile = os.path.join(params.storage_dir, 'queries.json')
+        self.logFile = os.path.join(params.storage_dir, 'queries.log')
+
+    def load(self):
+        stats = readJson(self.statsFile) or {}
+        # Queries appending meanwhile start new log
+        foldFile = '%s.%s' % (self.logFile, os.getpid())
+        try:
+            os.rename(self.logFile, foldFile)
+        except OSError:
+            return stats
+        fp = open(foldFile, 'r')
+        for line in fp:
+            for channel in line.split():
+                stats[channel] = stats.get(channel, 0) + 1
+        fp.close()
+        if writeJson(self.statsFile, stats):
+            os.remove(foldFile)
+        return stats
+
+    def record(self, channels):
+        if not channels:
+            return
+        try:
+            # Single small append is not interleaved with other writers
+            fp = open(self.logFile, 'a')
+            fp.write(' '.join(channels) + '\n')
+            fp.close()
+        except IOError as e:
+            log.warn('Failed record query: %s', e.strerror)
+
+
+##
+# Keeps schedules of next days harvested. Missing channel days are planned
+# as jobs queue persisted in storage, so interrupted run continues where
+# it stopped. Finished jobs are appended to log, a line per job, which is
+# folded into queue file when the next run starts. Most queried channels
+# are fetched first.
+##
+class Prefetcher:
+
+    def __init__(self, store, days=None):
+        self.store = store
+        self.params = store.params
+        self.days = days or config.getInt(self.params, 'prefetch_days', 7)
+        self.queueFile = os.path.join(self.params.storage_dir, 'prefetch.json')
+        self.logFile = os.path.join(self.params.storage_dir, 'prefetch.log')
+        self.lock = threading.Lock()
+        self.queue = None
+        self.jobsLog = None
+
+    def __listChannels(self):
+        catalog = self.store.getChannelCatalog()
+        if not catalog:
+            return []
+        selected = self.params.prefetch_channels
+        return catalog.resolve(selected and [name.strip() for name in selected.split(',')])
+
+    def plan(self):
+        today = datetime.date.today()
+        stats = QueryStats(self.params).load()
+        channels = self.__listChannels()
+        # Stable sort keeps catalog order among equally popular channels
+        channels.sort(key=lambda channel: -stats.get(channel, 0))
+
+        pending = []
+        for channel in channels:
+            for offset in range(self.days):
+                date = today + datetime.timedelta(days=offset)
+                if not self.store.hasChannelSchedule(channel, date):
+                    pending.append([channel, date.strftime('%Y-%m-%d')])
+
+        log.info('Planned prefetch of %s channel days', len(pending))
+        return {
+            'day': today.strftime('%Y-%m-%d'),
+            'days': self.days,
+            'pending': pending,
+            'done': 0,
+            'failed': [],
+        }
+
+    ##
+    # Apply finished jobs log of interrupted run to its queue
+    ##
+    def __fold(self, queue):
+        try:
+            fp = open(self.logFile, 'r')
+        except IOError:
+            return queue
+        finished = set()
+        for line in fp:
+            fields = line.split()
+            # Last line might be cut short by crash
+            if len(fields) != 3:
+                continue
+            status, channel, day = fields
+            finished.add((channel, day))
+            if status == 'done':
+                queue['done'] += 1
+            else:
+                queue['failed'].append([channel, day])
+        fp.close()
+        queue['pending'] = [job for job in queue['pending'] if tuple(job) not in finished]
+        return queue
+
+    def load(self):
+        queue = readJson(self.queueFile)
+        if queue:
+            queue = self.__fold(queue)
+        today = datetime.date.today().strftime('%Y-%m-%d')
+        if queue and queue.get('day') == today and queue.get('days') == self.days and queue['pending']:
+            log.info('Resume prefetch, %s channel days pending', len(queue['pending']))
+            return queue
+        return self.plan()
+
+    ##
+    # Queue is stored whole only when run starts and ends, log of jobs
+    # finished before is not needed then
+    ##
+    def __save(self):
+        if writeJson(self.queueFile, self.queue) and os.path.exists(self.logFile):
+            os.remove(self.logFile)
+
+    def __finish(self, job, success):
+        with self.lock:
+            self.queue['pending'].remove(job)
+            if success:
+                self.queue['done'] += 1
+            else:
+                self.queue['failed'].append(job)
+            try:
+                self.jobsLog.write('%s %s %s\n' % (success and 'done' or 'failed', job[0], job[1]))
+                self.jobsLog.flush()
+            except IOError as e:
+                log.warn('Failed log prefetch job: %s', e.strerror)
+
+    def __fetchChannel(self, jobs):
+        for job in jobs:
+            channel, day = job
+            date = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            # Schedule page of previous day might have covered this one
+            if self.store.hasChannelSchedule(channel, date):
+                self.__finish(job, True)
+                continue
+            shows = self.store.getChannelSchedule(channel, date)
+            self.__finish(job, shows != None)
+
+    ##
+    # Jobs are finished as writer stores pages covering them
+    ##
+    def __runPipeline(self, channelJobs):
+        jobs = dict(((channel, day), [channel, day]) for channel, day in self.queue['pending'])
+        channelDates = collections.OrderedDict()
+        for group in channelJobs:
+            for channel, day in group:
+                channelDates.setdefault(channel, []).append(datetime.datetime.strptime(day, '%Y-%m-%d').date())
+
+        def stored(channel, days):
+            for day in days:
+                job = jobs.pop((channel, day), None)
+                if job:
+                    self.__finish(job, True)
+
+        self.store.harvestChannelsDates(channelDates, stored)
+        for (channel, day), job in jobs.items():
+            date = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            self.__finish(job, self.store.hasChannelSchedule(channel, date))
+
+    def run(self):
+        if config.getBool(self.params, 'local_only'):
+            log.info('Found LOCAL_ONLY. Skipping prefetch')
+            return None
+
+        self.queue = self.load()
+        self.__save()
+        self.jobsLog = open(self.logFile, 'a')
+
+        channelJobs = []
+        for job in list(self.queue['pending']):
+            if len(channelJobs) == 0 or channelJobs[-1][0][0] != job[0]:
+                channelJobs.append([])
+            channelJobs[-1].append(job)
+
+        try:
+            if config.getInt(self.params, 'parse_processes', 0) > 0:
+                self.__runPipeline(channelJobs)
+            else:
+                pool = harvest.WorkerPool(config.getInt(self.params, 'workers', 1), 'prefetch')
+                pool.map(self.__fetchChannel, channelJobs)
+        finally:
+            self.jobsLog.close()
+        self.__save()
+
+        log.info('Prefetch finished: %s done, %s failed', self.queue['done'], len(self.queue['failed']))
+        return self.queue
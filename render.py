@@ -0,0 +1,112 @@
+import csv
+import json
+
+# Encoded rows are written out in chunks of this many
+FLUSH_ROWS = 500
+
+
+##
+# Query results rendered as table of columns. Rows are records, dicts
+# with column values, written out and UTF-8 encoded in chunks instead
+# of a write per row.
+##
+class Renderer:
+
+    def __init__(self, output, columns=None):
+        self.output = output
+        self.columns = columns
+        self.chunk = []
+
+    def write(self, data):
+        self.chunk.append(data)
+        if len(self.chunk) >= FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            data = ''.join(self.chunk)
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            self.output.write(data)
+            self.chunk = []
+        self.output.flush()
+
+    def begin(self):
+        pass
+
+    def row(self, record):
+        pass
+
+    def end(self):
+        self.flush()
+
+
+##
+# Human readable rows. Layout is printf format of record fields with
+# column widths already filled in by caller, once per result set.
+##
+class TextRenderer(Renderer):
+
+    def __init__(self, output, columns, layout):
+        Renderer.__init__(self, output, columns)
+        self.layout = layout + u'\n'
+
+    def row(self, record):
+        self.write(self.layout % record)
+
+
+##
+# Rows streamed as items of single JSON array
+##
+class JsonRenderer(Renderer):
+
+    def begin(self):
+        self.separator = '[\n'
+
+    def row(self, record):
+        self.write(self.separator + json.dumps(dict((name, record[name]) for name in self.columns), sort_keys=True))
+        self.separator = ',\n'
+
+    def end(self):
+        self.write(self.separator == '[\n' and '[]\n' or '\n]\n')
+        self.flush()
+
+
+class CsvRenderer(Renderer):
+
+    DIALECT = 'excel'
+
+    def begin(self):
+        # Python 2 csv writes bytes, values are encoded before
+        self.writer = csv.writer(self, dialect=self.DIALECT, lineterminator='\n')
+        self.writer.writerow(self.columns)
+
+    def encode(self, value):
+        if value == None:
+            return ''
+        if isinstance(value, bool):
+            return value and '1' or '0'
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def row(self, record):
+        self.writer.writerow([self.encode(record[name]) for name in self.columns])
+
+
+class TsvRenderer(CsvRenderer):
+
+    DIALECT = 'excel-tab'
+
+
+RENDER_FORMATS = {
+    'text': TextRenderer,
+    'json': JsonRenderer,
+    'csv': CsvRenderer,
+    'tsv': TsvRenderer,
+}
+
+def create(renderFormat, output, columns, layout):
+    if renderFormat == 'text':
+        return TextRenderer(output, columns, layout)
+    return RENDER_FORMATS[renderFormat](output, columns)
@@ -0,0 +1,218 @@
+import bisect
+import datetime
+import logging
+import operator
+
+log = logging.getLogger(__name__)
+
+
+MINUTES_DAY = 24 * 60
+
+def parseMinutes(text):
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def toMinutes(time):
+    if time == None:
+        return None
+    return time.hour * 60 + time.minute
+
+def formatMinutes(minutes):
+    return '%02d:%02d' % ((minutes // 60) % 24, minutes % 60)
+
+##
+# Set absolute 'start' and 'end' minutes from schedule day midnight in
+# show records. Schedule runs past midnight, so every time going back
+# rolls over to the next day; last show ends when first one starts
+# next day, same as schedule wraps around in listing.
+##
+def normalizeShows(shows):
+    offset = 0
+    previous = None
+    for show in shows:
+        start = parseMinutes(show['time']) + offset
+        if previous != None and start < previous:
+            offset += MINUTES_DAY
+            start += MINUTES_DAY
+        show['start'] = start
+        previous = start
+
+    for i in range(len(shows)):
+        if i + 1 < len(shows):
+            end = shows[i + 1]['start']
+        else:
+            end = shows[0]['start'] + MINUTES_DAY
+        if end <= shows[i]['start']:
+            end += MINUTES_DAY
+        shows[i]['end'] = end
+
+    return shows
+
+
+class Show(object):
+
+    __slots__ = ('channel', 'date', 'start', 'end', 'title', 'description')
+
+    def __init__(self, channel, date, start, end, title, description):
+        self.channel = channel
+        self.date = date
+        self.start = start
+        self.end = end
+        self.title = title
+        self.description = description
+
+    @property
+    def time(self):
+        return formatMinutes(self.start)
+
+    @property
+    def ends(self):
+        return formatMinutes(self.end)
+
+    ##
+    # Day minutes before schedule start belong to the next day tail,
+    # so both of them are checked.
+    ##
+    def isAiring(self, minutes):
+        return (self.start <= minutes < self.end or
+                self.start <= minutes + MINUTES_DAY < self.end)
+
+    ##
+    # On air at minutes of given day, shows of previous day schedule
+    # running past midnight included
+    ##
+    def isLive(self, day, minutes):
+        if self.date == day:
+            return self.start <= minutes < self.end
+        if self.date == day - datetime.timedelta(days=1):
+            return self.start <= minutes + MINUTES_DAY < self.end
+        return False
+
+    def overlaps(self, minutesFrom=None, minutesTo=None):
+        if minutesFrom != None and minutesTo != None and minutesTo < minutesFrom:
+            minutesTo += MINUTES_DAY
+        for shift in (0, MINUTES_DAY):
+            if minutesFrom != None and self.end < minutesFrom + shift:
+                continue
+            if minutesTo != None and self.start > minutesTo + shift:
+                continue
+            return True
+        return False
+
+    def __repr__(self):
+        return 'Show(%s %s %s-%s %r)' % (self.channel, self.date, self.time, self.ends, self.title)
+
+def makeShows(channel, date, shows):
+    if len(shows) > 0 and 'end' not in shows[0]:
+        normalizeShows(shows)
+    return [Show(channel, date, show['start'], show['end'], show['title'], show['description']) for show in shows]
+
+
+SHOW_START = operator.attrgetter('start')
+
+##
+# Shows of one channel schedule day sorted by start minutes. Show
+# overlapping some minute has to start no earlier than the longest show
+# duration before it, so lookups bisect that range and check only
+# candidates in it. Midnight straddling is handled by Show predicates.
+##
+class IntervalIndex:
+
+    def __init__(self, shows):
+        self.shows = sorted(shows, key=SHOW_START)
+        self.starts = [show.start for show in self.shows]
+        self.longest = max([show.end - show.start for show in self.shows] or [0])
+        # Results of lookups, by criteria
+        self.found = {}
+
+    def __candidates(self, minutesFrom, minutesTo):
+        lower = 0
+        upper = len(self.starts)
+        if minutesFrom != None:
+            lower = bisect.bisect_left(self.starts, minutesFrom - self.longest)
+        if minutesTo != None:
+            upper = bisect.bisect_right(self.starts, minutesTo)
+        return self.shows[lower:upper]
+
+    def at(self, minutes):
+        key = ('at', minutes)
+        if key not in self.found:
+            self.found[key] = self.__at(minutes)
+        return self.found[key]
+
+    def between(self, minutesFrom=None, minutesTo=None):
+        key = ('between', minutesFrom, minutesTo)
+        if key not in self.found:
+            self.found[key] = self.__between(minutesFrom, minutesTo)
+        return self.found[key]
+
+    def __at(self, minutes):
+        found = {}
+        for shift in (0, MINUTES_DAY):
+            for show in self.__candidates(minutes + shift, minutes + shift):
+                if show.isAiring(minutes):
+                    found[id(show)] = show
+        return sorted(found.values(), key=SHOW_START)
+
+    def __between(self, minutesFrom=None, minutesTo=None):
+        if minutesFrom != None and minutesTo != None and minutesTo < minutesFrom:
+            minutesTo += MINUTES_DAY
+        found = {}
+        for shift in (0, MINUTES_DAY):
+            lookupFrom = None
+            lookupTo = None
+            if minutesFrom != None:
+                lookupFrom = minutesFrom + shift
+            if minutesTo != None:
+                lookupTo = minutesTo + shift
+            for show in self.__candidates(lookupFrom, lookupTo):
+                if show.overlaps(minutesFrom, minutesTo):
+                    found[id(show)] = show
+        return sorted(found.values(), key=SHOW_START)
+
+
+SHOW_FIELDS = ('time', 'title', 'description')
+
+##
+# Merge harvested day shows into stored ones keyed by start minutes.
+# Harvested list is authoritative within its own start range, stored
+# shows outside of it are kept. Returns merged list and delta with
+# 'added', 'changed' and 'removed' shows.
+##
+def mergeShows(stored, harvested):
+    if len(stored) > 0 and 'start' not in stored[0]:
+        normalizeShows(stored)
+    if len(harvested) > 0 and 'start' not in harvested[0]:
+        normalizeShows(harvested)
+
+    delta = {'added': [], 'changed': [], 'removed': []}
+    if len(harvested) == 0:
+        return stored, delta
+
+    first = harvested[0]['start']
+    last = harvested[-1]['start']
+    storedShows = dict((show['start'], show) for show in stored)
+    harvestedShows = dict((show['start'], show) for show in harvested)
+
+    merged = []
+    for start, show in storedShows.items():
+        if start in harvestedShows:
+            continue
+        if first <= start <= last:
+            delta['removed'].append(show)
+        else:
+            merged.append(show)
+
+    for start, show in harvestedShows.items():
+        old = storedShows.get(start)
+        if old == None:
+            delta['added'].append(show)
+        elif any(old.get(field) != show.get(field) for field in SHOW_FIELDS):
+            delta['changed'].append(show)
+        merged.append(show)
+
+    merged.sort(key=lambda show: show['start'])
+    return normalizeShows(merged), delta
+
+def isChanged(delta):
+    return len(delta['added']) > 0 or len(delta['changed']) > 0 or len(delta['removed']) > 0
@@ -0,0 +1,182 @@
+import os
+import re
+import logging
+from datetime import datetime
+
+import storage
+import schedule
+
+log = logging.getLogger(__name__)
+
+
+WORD_PATTERN = re.compile('\w+', re.UNICODE)
+
+def decodeText(text):
+    if type(text) == str:
+        return text.decode('utf-8', 'replace')
+    return text or u''
+
+def splitWords(text, fold):
+    return WORD_PATTERN.findall(fold(decodeText(text)))
+
+##
+# Pattern words match prefixes of consecutive text words, in order
+##
+def matchesPhrase(words, textWords):
+    for offset in range(len(textWords) - len(words) + 1):
+        for index, word in enumerate(words):
+            if not textWords[offset + index].startswith(word):
+                break
+        else:
+            return True
+    return False
+
+
+class ShowIndex(storage.SqliteDatabase):
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            date TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            start_min INTEGER NOT NULL,
+            end_min INTEGER NOT NULL,
+            title TEXT,
+            description TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS docs_schedule ON docs (channel, date)',
+        '''CREATE TABLE IF NOT EXISTS terms (
+            term TEXT NOT NULL,
+            doc INTEGER NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS terms_term ON terms (term)',
+        'CREATE INDEX IF NOT EXISTS terms_doc ON terms (doc)',
+        '''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''',
+    ]
+    UPGRADE = [
+        'DROP TABLE IF EXISTS docs',
+        'DROP TABLE IF EXISTS terms',
+        'DROP TABLE IF EXISTS meta',
+    ]
+    VERSION = 2
+
+    ##
+    # Fold function normalizes text for matching, eg. case and diacritics
+    ##
+    def __init__(self, params, fold):
+        self.params = params
+        self.fold = fold
+        storage.SqliteDatabase.__init__(self, os.path.join(params.storage_dir, 'search.db'))
+
+    ##
+    # Harvests update index as they store schedules, but schedules stored
+    # before index existed are there only after full rebuild
+    ##
+    def isBuilt(self):
+        row = self.getConnection().execute("SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row != None and row[0] == str(self.VERSION)
+
+    def __delete(self, conn, channel, dateKey):
+        conn.execute('DELETE FROM terms WHERE doc IN (SELECT id FROM docs WHERE channel = ? AND date = ?)', (channel, dateKey))
+        conn.execute('DELETE FROM docs WHERE channel = ? AND date = ?', (channel, dateKey))
+
+    def remove(self, channel, date):
+        self.__delete(self.getConnection(), channel, date.strftime('%Y-%m-%d'))
+        self.commit()
+
+    def update(self, channel, date, shows):
+        conn = self.getConnection()
+        dateKey = date.strftime('%Y-%m-%d')
+        self.__delete(conn, channel, dateKey)
+        for position, show in enumerate(schedule.makeShows(channel, date, shows)):
+            cursor = conn.execute('INSERT INTO docs (channel, date, position, start_min, end_min, title, description) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (channel, dateKey, position, show.start, show.end, show.title, show.description))
+            words = set(splitWords(show.title, self.fold) + splitWords(show.description, self.fold))
+            conn.executemany('INSERT INTO terms (term, doc) VALUES (?, ?)', [(word, cursor.lastrowid) for word in words])
+        self.commit()
+
+    ##
+    # Index all schedules available in storage from scratch, history
+    # archive schedules are indexed too when given
+    ##
+    def rebuild(self, store, history=None, batchSize=500):
+        log.info('Rebuilding show search index')
+        conn = self.getConnection()
+        with self.batch():
+            conn.execute('DELETE FROM terms')
+            conn.execute('DELETE FROM docs')
+        count = 0
+        for source in filter(None, (history, store)):
+            schedules = list(source.listAllSchedules())
+            for offset in range(0, len(schedules), batchSize):
+                with self.batch():
+                    for channel, date in schedules[offset:offset + batchSize]:
+                        shows = source.readSchedule(channel, date)
+                        if shows:
+                            self.update(channel, date, shows)
+            count += len(schedules)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (str(self.VERSION),))
+        self.commit()
+        log.info('Indexed %s schedules', count)
+        return count
+
+    def __lookupWord(self, word):
+        # Words match as prefixes, range scan over sorted terms index
+        rows = self.getConnection().execute('SELECT doc FROM terms WHERE term >= ? AND term < ?', (word, word + u'\uffff'))
+        return set(row[0] for row in rows)
+
+    ##
+    # Find shows containing all pattern words as title/description word
+    # prefixes. Result maps (channel, date) to Show records ordered by
+    # schedule position, None when pattern has no searchable words.
+    ##
+    def search(self, pattern, channels=None, dates=None):
+        pattern = self.fold(decodeText(pattern)).strip()
+        words = WORD_PATTERN.findall(pattern)
+        if len(words) == 0:
+            return None
+
+        docs = None
+        for word in sorted(words, key=len, reverse=True):
+            matched = self.__lookupWord(word)
+            if docs == None:
+                docs = matched
+            else:
+                docs &= matched
+            if not docs:
+                break
+
+        result = {}
+        if not docs:
+            return result
+
+        conn = self.getConnection()
+        dateKeys = None
+        if dates != None:
+            dateKeys = dict((date.strftime('%Y-%m-%d'), date) for date in dates)
+        docIds = sorted(docs)
+        for offset in range(0, len(docIds), 500):
+            chunk = docIds[offset:offset + 500]
+            rows = conn.execute('SELECT channel, date, position, start_min, end_min, title, description FROM docs WHERE id IN (%s)'
+                                % ','.join('?' * len(chunk)), chunk)
+            for channel, date, position, start, end, title, description in rows:
+                if channels != None and channel not in channels:
+                    continue
+                if dateKeys != None and date not in dateKeys:
+                    continue
+                # Multiple words pattern still has to match as a phrase
+                if len(words) > 1 and not matchesPhrase(words, splitWords(title, self.fold) + splitWords(description, self.fold)):
+                    continue
+                if dateKeys != None:
+                    showDate = dateKeys[date]
+                else:
+                    showDate = datetime.strptime(date, '%Y-%m-%d').date()
+                result.setdefault((channel, date), []).append((position, schedule.Show(channel, showDate, start, end, title, description)))
+
+        for key in result:
+            result[key] = [show for position, show in sorted(result[key])]
+        return result
@@ -0,0 +1,283 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import json
+import time
+import gzip
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import StringIO
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import logging
+
+log = logging.getLogger(__name__)
+
+SCHEDULE_PATH = re.compile('^/tv-programa/televizija/([\w\-]+)/(\d+)(?:/(\d{4})_(\d\d)_(\d\d))?/?$')
+
+GROUPS = [u'Lietuvos', u'Pažintiniai', u'Filmai', u'Sportas', u'Vaikams']
+
+WEEKDAYS = [u'Pirmadienis', u'Antradienis', u'Trečiadienis', u'Ketvirtadienis', u'Penktadienis', u'Šeštadienis', u'Sekmadienis']
+
+##
+# Page layout templates, modelled on recorded tvprograma.lt pages. Items
+# come in the variants seen there: with description, live title span,
+# inline image, extra span after the title, comment right after the time
+# and item nested in another one. Saved pages make the parser --verify set.
+##
+PAGE = (u'<!DOCTYPE html><html><head><meta charset="utf-8"><title>%(title)s</title></head><body>'
+        u'<form id="topsearch_form" action="/paieska"><input type="text" name="q"><script type="text/javascript">'
+        u'var search = 1;\nvar channels = %(channels)s;\n</script></form>'
+        u'<div class="wrap"><div class="channel-list">%(days)s</div></div></body></html>')
+
+DAY = u'<div class="channel col"><header> <b>%(weekday)s</b> %(date)s <br></header><div class="items">%(items)s</div></div>'
+
+ITEMS = [
+    u'<div class="item"><span class="time">%(time)s</span> Žinios &amp; orai %(number)s<p class="description">Aprašymas &#268;ia <i>kursyvu</i></p></div>',
+    u'<div class="item live"><span class="time"> %(time)s </span> <span class="title">Filmas &quot;%(number)s&quot;</span></div>',
+    u'<div class="item"><span>%(time)s</span>\n  Serialas <img src="a.png">\n<div class="description"> Serija %(number)s </div></div>',
+    u'<div class="item"><span>%(time)s</span> Laida %(number)s<br/><span>papildoma</span></div>',
+    u'<div class="item"><span class="time">%(time)s</span><!-- Reklama -->Laida %(number)s</div>',
+    u'<div class="item"><span>%(time)s</span> Rinkinys <div class="item"><span>%(time)s</span> Dalis %(number)s</div></div>',
+]
+
+
+##
+# Synthesised site of N channels with schedules of D days from today.
+# Pages are generated once and kept encoded, same page every request, so
+# response cache validators and parse results stay stable.
+##
+class Site:
+
+    def __init__(self, channels=10, days=7, span=3, shows=30):
+        self.days = days
+        self.span = max(1, span)
+        self.shows = max(1, shows)
+        self.today = datetime.date.today()
+        self.channels = []
+        for number in range(1, channels + 1):
+            name = 'kanalas-%d' % number
+            self.channels.append({
+                'value': str(number),
+                'label': u'Kanalas Ž%d' % number,
+                'link': '/tv-programa/televizija/%s/%d' % (name, number),
+                'category': GROUPS[(number - 1) % len(GROUPS)],
+            })
+        self.byName = dict((channel['link'].split('/')[-2], channel) for channel in self.channels)
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def formatDay(self, channel, date):
+        rand = random.Random('%s-%s' % (channel['value'], date))
+        step = 24 * 60 // self.shows
+        items = []
+        for number in range(self.shows):
+            minutes = number * step + rand.randint(0, max(0, step - 1))
+            items.append(rand.choice(ITEMS) % {
+                'time': '%02d:%02d' % (minutes // 60, minutes % 60),
+                'number': rand.randint(1, 99),
+            })
+        return DAY % {
+            'weekday': WEEKDAYS[date.weekday()],
+            'date': date.strftime('%m-%d'),
+            'items': u''.join(items),
+        }
+
+    def formatPage(self, title, days):
+        return (PAGE % {
+            'title': title,
+            'channels': json.dumps(self.channels),
+            'days': u''.join(days),
+        }).encode('utf-8')
+
+    ##
+    # Encoded page of path, None for unknown channel or date out of range
+    ##
+    def getPage(self, path):
+        with self.lock:
+            page = self.pages.get(path)
+        if page:
+            return page
+
+        if path == '/':
+            data = self.formatPage(u'TV programa', [])
+        else:
+            match = SCHEDULE_PATH.match(path)
+            if not match:
+                return None
+            channel = self.byName.get(match.group(1))
+            if not channel or channel['value'] != match.group(2):
+                return None
+            if match.group(3):
+                date = datetime.date(*[int(part) for part in match.group(3, 4, 5)])
+            else:
+                date = self.today
+            offset = (date - self.today).days
+            if offset < 0 or offset >= self.days:
+                return None
+            dates = [date + datetime.timedelta(days=day) for day in range(min(self.span, self.days - offset))]
+            data = self.formatPage(channel['label'], [self.formatDay(channel, day) for day in dates])
+
+        fp = StringIO.StringIO()
+        zp = gzip.GzipFile(fileobj=fp, mode='wb', mtime=0)
+        zp.write(data)
+        zp.close()
+        page = {'data': data, 'gzip': fp.getvalue(), 'etag': '"%s"' % hashlib.sha1(data).hexdigest()}
+        with self.lock:
+            self.pages[path] = page
+        return page
+
+
+##
+# Requests admitted per second from all clients, burst allowed at once.
+# Requests over the rate are answered 429 as the real site would do for
+# aggressive crawlers.
+##
+class Throttle:
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def admit(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = {}
+
+    def record(self, status, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def report(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes, 'statuses': dict(self.statuses)}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive connections, same as the real site
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status, data='', headers=None, counted=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if counted:
+            self.server.stats.record(status, len(data))
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse.urlsplit(self.path).path
+        if path == '/_stats':
+            self.send(200, json.dumps(server.stats.report()), {'Content-Type': 'application/json'}, False)
+            return
+
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep((server.latency + random.random() * server.jitter) / 1000.0)
+
+        if not server.throttle.admit():
+            self.send(429, 'Too many requests', {'Retry-After': '1'})
+            return
+        if server.errorRate > 0 and random.random() < server.errorRate:
+            self.send(500, 'Internal server error')
+            return
+
+        page = server.site.getPage(path)
+        if not page:
+            self.send(404, 'Not found')
+            return
+        if self.headers.get('If-None-Match') == page['etag']:
+            self.send(304, '', {'ETag': page['etag']})
+            return
+
+        headers = {'Content-Type': 'text/html; charset=utf-8', 'ETag': page['etag']}
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            headers['Content-Encoding'] = 'gzip'
+            self.send(200, page['gzip'], headers)
+        else:
+            self.send(200, page['data'], headers)
+
+    def log_message(self, fmt, *args):
+        log.debug('%s %s', self.address_string(), fmt % args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, site, latency=0, jitter=0, errorRate=0.0, rate=0, burst=1):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.throttle = Throttle(rate, burst)
+        self.stats = Stats()
+
+    def getUrl(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local tvprograma.lt stand-in for harvest tests and benchmarks')
+    parser.add_argument('-H', '--host', action='store', default='127.0.0.1', help='Listen address')
+    parser.add_argument('-p', '--port', action='store', type=int, default=8080, help='Listen port, 0 picks free one')
+    parser.add_argument('-n', '--channels', action='store', type=int, default=10, help='Channels on site')
+    parser.add_argument('-d', '--days', action='store', type=int, default=7, help='Days of schedules from today')
+    parser.add_argument('--span', action='store', type=int, default=3, help='Days covered by one schedule page')
+    parser.add_argument('--shows', action='store', type=int, default=30, help='Shows per channel day')
+    parser.add_argument('--latency', action='store', type=float, default=0, help='Response delay in milliseconds')
+    parser.add_argument('--jitter', action='store', type=float, default=0, help='Random extra delay up to milliseconds')
+    parser.add_argument('--error-rate', action='store', type=float, default=0.0, help='Fraction of requests answered 500')
+    parser.add_argument('--rate', action='store', type=float, default=0, help='Requests per second admitted, others answered 429 (0 unlimited)')
+    parser.add_argument('--burst', action='store', type=int, default=1, help='Requests admitted at once over rate')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.verbose and logging.DEBUG or logging.WARNING)
+    site = Site(args.channels, args.days, args.span, args.shows)
+    server = Server((args.host, args.port), site, args.latency, args.jitter, args.error_rate, args.rate, args.burst)
+    # First line is read by harvestbench.py to learn picked port
+    sys.stdout.write('Serving %s\n' % server.getUrl())
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
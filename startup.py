@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+
+import os
+import sys
+import time
+
+GUIDE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'guide.py')
+
+SCENARIOS = [
+    ('channels', ['-c']),
+    ('groups', ['-g']),
+    ('now', []),
+]
+
+##
+# Run guide.py in this process with __import__ wrapped, report loaded
+# modules in the same form as python3 -X importtime does
+##
+def child(args):
+    import __builtin__
+    origImport = __builtin__.__import__
+    stack = [0.0]
+    report = []
+
+    def timedImport(name, *rest, **kwargs):
+        fresh = name not in sys.modules
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return origImport(name, *rest, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            stack[-1] += elapsed
+            if fresh and name in sys.modules:
+                report.append((int((elapsed - children) * 1e6), int(elapsed * 1e6), len(stack) - 1, name))
+
+    __builtin__.__import__ = timedImport
+    sys.argv = [GUIDE_PATH] + args
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        execfile(GUIDE_PATH, {'__name__': '__main__', '__file__': GUIDE_PATH})
+    finally:
+        sys.stdout = stdout
+        __builtin__.__import__ = origImport
+
+    print('import time: self [us] | cumulative | imported package')
+    for selfTime, cumulative, depth, name in report:
+        print('import time: %9d | %10d | %s%s' % (selfTime, cumulative, '  ' * depth, name))
+
+def measure(args, runs):
+    import subprocess
+    timings = []
+    devnull = open(os.devnull, 'w')
+    for i in range(runs):
+        start = time.time()
+        subprocess.call([sys.executable, GUIDE_PATH] + args, stdout=devnull, stderr=devnull)
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[0], timings[-1]
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        return child(sys.argv[2:])
+
+    # Imported after child mode so they do not hide guide.py imports
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(description='TV Guide startup time benchmark for cached queries')
+    parser.add_argument('-r', '--runs', action='store', type=int, default=10, help='Runs of each scenario')
+    parser.add_argument('-b', '--budget', action='store', type=float, default=150, help='Median wall time budget, ms')
+    parser.add_argument('-i', '--imports', action='store_true', help='Report module import times of each scenario')
+    args = parser.parse_args()
+
+    failed = 0
+    print('%-10s %10s %10s %10s' % ('scenario', 'median ms', 'min ms', 'max ms'))
+    for name, scenario in SCENARIOS:
+        median, fastest, slowest = measure(scenario, args.runs)
+        over = median > args.budget
+        failed += over
+        print('%-10s %10.1f %10.1f %10.1f%s' % (name, median, fastest, slowest, over and '  OVER BUDGET' or ''))
+
+    if args.imports:
+        for name, scenario in SCENARIOS:
+            print('')
+            print('== %s: guide.py %s' % (name, ' '.join(scenario)))
+            sys.stdout.flush()
+            subprocess.call([sys.executable, os.path.abspath(__file__), '--child'] + scenario)
+
+    sys.exit(failed and 1 or 0)
+
+main()
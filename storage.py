@@ -0,0 +1,544 @@
+import os
+import re
+import json
+import time
+import struct
+import threading
+import contextlib
+import logging
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+def readJson(fileName):
+    try:
+        fp = open(fileName, 'r')
+        data = json.load(fp)
+        fp.close()
+        return data
+    except Exception as e:
+        log.debug('Failed read JSON: %s', fileName)
+        return
+
+##
+# File is written next to destination and renamed over it, so readers
+# never see partially written file
+##
+def writeAtomic(fileName, writer):
+    tempName = '%s.%s-%s.tmp' % (fileName, os.getpid(), threading.current_thread().ident)
+    try:
+        fp = open(tempName, 'wb')
+        writer(fp)
+        fp.close()
+        os.rename(tempName, fileName)
+        return True
+    except Exception as e:
+        log.warn('Failed write: %s (%s)', fileName, e)
+        if os.path.exists(tempName):
+            os.remove(tempName)
+        return False
+
+def writeJson(fileName, data):
+    return writeAtomic(fileName, lambda fp: json.dump(data, fp))
+
+
+class JsonFormat:
+
+    EXTENSION = '.json'
+
+    def read(self, fileName):
+        return readJson(fileName)
+
+    def write(self, fileName, shows):
+        return writeJson(fileName, shows)
+
+
+class GzipFormat:
+
+    EXTENSION = '.json.gz'
+
+    def read(self, fileName):
+        import gzip
+        try:
+            fp = gzip.open(fileName, 'rb')
+            data = json.load(fp)
+            fp.close()
+            return data
+        except Exception as e:
+            log.debug('Failed read gzip JSON: %s', fileName)
+            return
+
+    def write(self, fileName, shows):
+        import gzip
+        def writer(fp):
+            zp = gzip.GzipFile(fileobj=fp, mode='wb', mtime=0)
+            json.dump(shows, zp, separators=(',', ':'))
+            zp.close()
+        return writeAtomic(fileName, writer)
+
+
+##
+# Binary show records with string table, zlib compressed after header.
+# Field names and texts repeat a lot (titles, dates, empty descriptions),
+# so every distinct string is stored once and shows refer to it by index.
+##
+class PackedFormat:
+
+    EXTENSION = '.tvs'
+    MAGIC = 'TVS'
+    VERSION = 1
+
+    def read(self, fileName):
+        import zlib
+        try:
+            fp = open(fileName, 'rb')
+            data = fp.read()
+            fp.close()
+            if data[:3] != self.MAGIC:
+                raise ValueError('bad magic')
+            if ord(data[3]) != self.VERSION:
+                raise ValueError('unsupported version %d' % ord(data[3]))
+            return self.unpack(zlib.decompress(data[4:]))
+        except Exception as e:
+            log.debug('Failed read packed schedule: %s (%s)', fileName, e)
+            return
+
+    def write(self, fileName, shows):
+        import zlib
+        try:
+            data = self.MAGIC + chr(self.VERSION) + zlib.compress(self.pack(shows), 6)
+        except Exception as e:
+            log.warn('Failed pack schedule: %s (%s)', fileName, e)
+            return False
+        return writeAtomic(fileName, lambda fp: fp.write(data))
+
+    ##
+    # Show record is start and end minutes followed by text fields as
+    # (name, value) string table index pairs
+    ##
+    def pack(self, shows):
+        if len(shows) > 0 and 'start' not in shows[0]:
+            import schedule
+            shows = schedule.normalizeShows([dict(show) for show in shows])
+        strings = {}
+        table = []
+
+        def intern(text):
+            if text not in strings:
+                strings[text] = len(table)
+                table.append(text)
+            return strings[text]
+
+        rows = []
+        for show in shows:
+            fields = [(intern(name), intern(value)) for name, value in sorted(show.items())
+                      if name not in ('start', 'end')]
+            rows.append(struct.pack('<HHB', show['start'], show['end'], len(fields)))
+            rows.extend(struct.pack('<II', name, value) for name, value in fields)
+
+        parts = [struct.pack('<I', len(table))]
+        for text in table:
+            encoded = unicode(text).encode('utf-8')
+            parts.append(struct.pack('<I', len(encoded)))
+            parts.append(encoded)
+        parts.append(struct.pack('<I', len(shows)))
+        parts.extend(rows)
+        return ''.join(parts)
+
+    def unpack(self, data):
+        offset = 4
+        table = []
+        for i in range(struct.unpack_from('<I', data, 0)[0]):
+            size = struct.unpack_from('<I', data, offset)[0]
+            offset += 4
+            table.append(data[offset:offset + size].decode('utf-8'))
+            offset += size
+        count = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        shows = []
+        for i in range(count):
+            start, end, fields = struct.unpack_from('<HHB', data, offset)
+            offset += 5
+            show = {'start': start, 'end': end}
+            for j in range(fields):
+                name, value = struct.unpack_from('<II', data, offset)
+                offset += 8
+                show[table[name]] = table[value]
+            shows.append(show)
+        return shows
+
+
+SCHEDULE_FORMATS = {
+    'json': JsonFormat,
+    'gzip': GzipFormat,
+    'packed': PackedFormat,
+}
+
+def getScheduleFormat(params):
+    name = params.storage_format or 'json'
+    if name not in SCHEDULE_FORMATS:
+        log.warn('Unknown storage format "%s", using json', name)
+        name = 'json'
+    return SCHEDULE_FORMATS[name]()
+
+
+##
+# Schedule file per channel day. New files are written in STORAGE_FORMAT,
+# files of other formats (eg. legacy plain JSON) are still read and get
+# replaced by the next save.
+##
+class JsonStorage:
+
+    SCHEDULE_PATTERN = re.compile("^(.+)\-(\d{8})(\.json|\.json\.gz|\.tvs)$")
+
+    def __init__(self, params):
+        self.params = params
+        self.storageDir = params.storage_dir
+        self.format = getScheduleFormat(params)
+        # Configured format first, it is found on the first stat mostly
+        self.formats = [self.format] + [cls() for name, cls in sorted(SCHEDULE_FORMATS.items())
+                                        if not isinstance(self.format, cls)]
+
+    def __getChannelsCache(self):
+        return os.path.join(self.storageDir, 'channels.json')
+
+    def __getScheduleCache(self, channel, date, scheduleFormat):
+        fileName = "%s-%s%s" % (channel, date.strftime("%Y%m%d"), scheduleFormat.EXTENSION)
+        return os.path.join(self.storageDir, fileName)
+
+    def __findSchedule(self, channel, date):
+        for scheduleFormat in self.formats:
+            fileName = self.__getScheduleCache(channel, date, scheduleFormat)
+            if os.path.isfile(fileName):
+                return fileName, scheduleFormat
+        return None, None
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Every file write is complete on its own
+        yield
+
+    def readChannelList(self):
+        return readJson(self.__getChannelsCache())
+
+    def saveChannelList(self, channels):
+        return writeJson(self.__getChannelsCache(), channels)
+
+    def getChannelListStamp(self):
+        try:
+            return os.path.getmtime(self.__getChannelsCache())
+        except OSError:
+            return None
+
+    def hasSchedule(self, channel, date):
+        return self.__findSchedule(channel, date)[0] != None
+
+    def listSchedules(self, channel):
+        debug = log.isEnabledFor(logging.DEBUG)
+        dates = set()
+        for fileName in os.listdir(self.storageDir):
+            match = self.SCHEDULE_PATTERN.match(fileName)
+            if not match or match.group(1) != channel:
+                continue
+            matchDate = match.group(2)
+            if debug:
+                log.debug('Found "%s" schedule at: %s', channel, matchDate)
+            dates.add(datetime.strptime(matchDate, '%Y%m%d').date())
+
+        return sorted(dates)
+
+    def listAllSchedules(self):
+        found = set()
+        for fileName in sorted(os.listdir(self.storageDir)):
+            match = self.SCHEDULE_PATTERN.match(fileName)
+            if not match or match.group(1, 2) in found:
+                continue
+            found.add(match.group(1, 2))
+            yield match.group(1), datetime.strptime(match.group(2), '%Y%m%d').date()
+
+    def isCurrentFormat(self, channel, date):
+        return self.__findSchedule(channel, date)[1] is self.format
+
+    def getScheduleStamp(self, channel, date):
+        fileName = self.__findSchedule(channel, date)[0]
+        try:
+            return fileName and os.path.getmtime(fileName)
+        except OSError:
+            return None
+
+    def readSchedule(self, channel, date):
+        fileName, scheduleFormat = self.__findSchedule(channel, date)
+        if not fileName:
+            return None
+        return scheduleFormat.read(fileName)
+
+    def deleteSchedule(self, channel, date):
+        for scheduleFormat in self.formats:
+            fileName = self.__getScheduleCache(channel, date, scheduleFormat)
+            if os.path.isfile(fileName):
+                os.remove(fileName)
+        return True
+
+    def saveSchedule(self, channel, date, shows):
+        if not self.format.write(self.__getScheduleCache(channel, date, self.format), shows):
+            return False
+        for scheduleFormat in self.formats[1:]:
+            fileName = self.__getScheduleCache(channel, date, scheduleFormat)
+            if os.path.isfile(fileName):
+                log.debug('Remove %s schedule in old format: %s', channel, fileName)
+                os.remove(fileName)
+        return True
+
+
+class SqliteDatabase:
+
+    SCHEMA = []
+    # Statements run once for databases older than VERSION, errors ignored
+    UPGRADE = []
+    VERSION = 0
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self.local = threading.local()
+        self.getConnection()
+
+    ##
+    # SQLite connections can not be shared between harvest threads
+    ##
+    def getConnection(self):
+        conn = getattr(self.local, 'conn', None)
+        if not conn:
+            import sqlite3
+            log.debug('Open SQLite database: %s', self.dbFile)
+            conn = sqlite3.connect(self.dbFile, timeout=30)
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < self.VERSION:
+                log.debug('Upgrade SQLite database %s from version %s', self.dbFile, version)
+                for statement in self.UPGRADE:
+                    try:
+                        conn.execute(statement)
+                    except sqlite3.OperationalError:
+                        pass
+                conn.execute('PRAGMA user_version = %d' % self.VERSION)
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    ##
+    # Group writes into one transaction, nested batches join the outer one
+    ##
+    @contextlib.contextmanager
+    def batch(self):
+        conn = self.getConnection()
+        self.local.depth += 1
+        try:
+            yield
+        except:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                conn.rollback()
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            conn.commit()
+
+    def commit(self):
+        if self.local.depth == 0:
+            self.getConnection().commit()
+
+
+class SqliteStorage(SqliteDatabase):
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS channels (
+            position INTEGER NOT NULL,
+            name TEXT PRIMARY KEY,
+            label TEXT,
+            grp TEXT,
+            data TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS channels_label ON channels (label)',
+        'CREATE INDEX IF NOT EXISTS channels_grp ON channels (grp)',
+        '''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS schedules (
+            channel TEXT NOT NULL,
+            date TEXT NOT NULL,
+            saved REAL,
+            PRIMARY KEY (channel, date)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS shows (
+            channel TEXT NOT NULL,
+            date TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            time TEXT NOT NULL,
+            title TEXT,
+            description TEXT,
+            start_min INTEGER,
+            end_min INTEGER,
+            PRIMARY KEY (channel, date, position)
+        )''',
+        'CREATE INDEX IF NOT EXISTS shows_start ON shows (date, time)',
+    ]
+    UPGRADE = [
+        'ALTER TABLE shows ADD COLUMN start_min INTEGER',
+        'ALTER TABLE shows ADD COLUMN end_min INTEGER',
+        'ALTER TABLE schedules ADD COLUMN saved REAL',
+    ]
+    VERSION = 2
+
+    def __init__(self, params):
+        self.params = params
+        SqliteDatabase.__init__(self, os.path.join(params.storage_dir, params.storage_db or 'guide.db'))
+
+    def __formatDate(self, date):
+        return date.strftime('%Y-%m-%d')
+
+    def readChannelList(self):
+        rows = self.getConnection().execute('SELECT data FROM channels ORDER BY position').fetchall()
+        if len(rows) == 0:
+            return None
+        return [json.loads(row[0]) for row in rows]
+
+    def saveChannelList(self, channels):
+        conn = self.getConnection()
+        conn.execute('DELETE FROM channels')
+        conn.executemany('INSERT OR REPLACE INTO channels (position, name, label, grp, data) VALUES (?, ?, ?, ?, ?)',
+                         [(position, channel['name'], channel.get('label'), channel.get('group'), json.dumps(channel))
+                          for position, channel in enumerate(channels)])
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('channels_saved', repr(time.time())))
+        self.commit()
+        return True
+
+    def getChannelListStamp(self):
+        row = self.getConnection().execute('SELECT value FROM meta WHERE key = ?', ('channels_saved',)).fetchone()
+        return row and row[0] or None
+
+    def hasSchedule(self, channel, date):
+        row = self.getConnection().execute('SELECT 1 FROM schedules WHERE channel = ? AND date = ?',
+                                             (channel, self.__formatDate(date))).fetchone()
+        return row != None
+
+    def getScheduleStamp(self, channel, date):
+        row = self.getConnection().execute('SELECT saved FROM schedules WHERE channel = ? AND date = ?',
+                                             (channel, self.__formatDate(date))).fetchone()
+        return row and row[0] or None
+
+    def listSchedules(self, channel):
+        rows = self.getConnection().execute('SELECT date FROM schedules WHERE channel = ? ORDER BY date', (channel,))
+        return [datetime.strptime(row[0], '%Y-%m-%d').date() for row in rows]
+
+    def listAllSchedules(self):
+        rows = self.getConnection().execute('SELECT channel, date FROM schedules ORDER BY channel, date').fetchall()
+        for channel, date in rows:
+            yield channel, datetime.strptime(date, '%Y-%m-%d').date()
+
+    def readSchedule(self, channel, date):
+        conn = self.getConnection()
+        dateKey = self.__formatDate(date)
+        if not self.hasSchedule(channel, date):
+            return None
+        rows = conn.execute('SELECT date, time, title, description, start_min, end_min FROM shows WHERE channel = ? AND date = ? ORDER BY position',
+                            (channel, dateKey))
+        shows = []
+        for row in rows:
+            show = {'date': row[0], 'time': row[1], 'title': row[2], 'description': row[3]}
+            if row[4] != None:
+                show['start'] = row[4]
+                show['end'] = row[5]
+            shows.append(show)
+        return shows
+
+    def saveSchedule(self, channel, date, shows):
+        import sqlite3
+        conn = self.getConnection()
+        dateKey = self.__formatDate(date)
+        try:
+            conn.execute('INSERT OR REPLACE INTO schedules (channel, date, saved) VALUES (?, ?, ?)', (channel, dateKey, time.time()))
+            conn.execute('DELETE FROM shows WHERE channel = ? AND date = ?', (channel, dateKey))
+            conn.executemany('INSERT INTO shows (channel, date, position, time, title, description, start_min, end_min) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(channel, show.get('date', dateKey), position, show['time'], show['title'], show['description'],
+                               show.get('start'), show.get('end'))
+                              for position, show in enumerate(shows)])
+            self.commit()
+        except sqlite3.Error as e:
+            log.warn('Failed write schedule %s (%s): %s', channel, date, e)
+            return False
+        return True
+
+    def deleteSchedule(self, channel, date):
+        import sqlite3
+        conn = self.getConnection()
+        dateKey = self.__formatDate(date)
+        try:
+            conn.execute('DELETE FROM schedules WHERE channel = ? AND date = ?', (channel, dateKey))
+            conn.execute('DELETE FROM shows WHERE channel = ? AND date = ?', (channel, dateKey))
+            self.commit()
+        except sqlite3.Error as e:
+            log.warn('Failed delete schedule %s (%s): %s', channel, date, e)
+            return False
+        return True
+
+
+STORAGE_BACKENDS = {
+    'json': JsonStorage,
+    'sqlite': SqliteStorage,
+}
+
+def getStorage(params):
+    backend = params.storage_backend or 'json'
+    if backend not in STORAGE_BACKENDS:
+        log.warn('Unknown storage backend "%s", using json', backend)
+        backend = 'json'
+    return STORAGE_BACKENDS[backend](params)
+
+##
+# One-shot import of JSON files tree into configured storage backend
+##
+def migrate(params, batchSize=500):
+    source = JsonStorage(params)
+    target = getStorage(params)
+    if isinstance(target, JsonStorage):
+        return convert(target)
+
+    channels = source.readChannelList()
+    if channels:
+        target.saveChannelList(channels)
+
+    count = 0
+    schedules = list(source.listAllSchedules())
+    for offset in range(0, len(schedules), batchSize):
+        with target.batch():
+            for channel, date in schedules[offset:offset + batchSize]:
+                shows = source.readSchedule(channel, date)
+                if shows == None:
+                    continue
+                target.saveSchedule(channel, date, shows)
+                count += 1
+        log.debug('Migrated %s schedules', count)
+
+    log.info('Migrated %s schedules into %s', count, params.storage_backend)
+    return count
+
+##
+# Rewrite schedule files of other formats into configured STORAGE_FORMAT
+##
+def convert(store):
+    count = 0
+    for channel, date in list(store.listAllSchedules()):
+        if store.isCurrentFormat(channel, date):
+            continue
+        shows = store.readSchedule(channel, date)
+        if shows == None:
+            continue
+        store.saveSchedule(channel, date, shows)
+        count += 1
+
+    log.info('Converted %s schedules into %s format', count, store.params.storage_format or 'json')
+    return count
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import config
+import storage
+import schedule
+
+##
+# Write and read every stored schedule in each format into a scratch dir,
+# report time and file size per channel day
+##
+def measure(scheduleFormat, schedules, runs):
+    tempDir = tempfile.mkdtemp(prefix='storebench-')
+    try:
+        fileNames = [os.path.join(tempDir, '%s-%s%s' % (channel, date.strftime('%Y%m%d'), scheduleFormat.EXTENSION))
+                     for channel, date, shows in schedules]
+
+        writeTime = 0
+        readTime = 0
+        for run in range(runs):
+            start = time.time()
+            for fileName, (channel, date, shows) in zip(fileNames, schedules):
+                scheduleFormat.write(fileName, shows)
+            writeTime += time.time() - start
+
+            start = time.time()
+            for fileName in fileNames:
+                scheduleFormat.read(fileName)
+            readTime += time.time() - start
+
+        mismatch = 0
+        for fileName, (channel, date, shows) in zip(fileNames, schedules):
+            if scheduleFormat.read(fileName) != shows:
+                mismatch += 1
+
+        size = sum(os.path.getsize(fileName) for fileName in fileNames)
+        days = len(schedules) * runs
+        return writeTime * 1e6 / days, readTime * 1e6 / days, size / float(len(schedules)), mismatch
+    finally:
+        shutil.rmtree(tempDir)
+
+def main():
+    parser = argparse.ArgumentParser(description='TV Guide schedule storage format benchmark')
+    parser.add_argument('-r', '--runs', action='store', type=int, default=5, help='Write/read rounds of each format')
+    parser.add_argument('-f', '--format', action='append', choices=sorted(storage.SCHEDULE_FORMATS.keys()), help='Format to measure, all by default')
+    args = parser.parse_args()
+
+    params = config.load(__file__)
+    source = storage.JsonStorage(params)
+    schedules = []
+    for channel, date in source.listAllSchedules():
+        shows = source.readSchedule(channel, date)
+        if shows:
+            # Stored schedules always carry start/end minutes
+            schedules.append((channel, date, schedule.normalizeShows(shows)))
+    if len(schedules) == 0:
+        print('No schedules found in %s' % params.storage_dir)
+        sys.exit(1)
+
+    print('%s channel days, %s runs' % (len(schedules), args.runs))
+    print('%-8s %12s %12s %12s %9s' % ('format', 'write us/day', 'read us/day', 'bytes/day', 'mismatch'))
+    failed = 0
+    for name in args.format or sorted(storage.SCHEDULE_FORMATS.keys()):
+        writeTime, readTime, size, mismatch = measure(storage.SCHEDULE_FORMATS[name](), schedules, args.runs)
+        failed += mismatch
+        print('%-8s %12.1f %12.1f %12.1f %9d' % (name, writeTime, readTime, size, mismatch))
+
+    sys.exit(failed and 1 or 0)
+
+main()
@@ -0,0 +1,291 @@
+import re
+import json
+import logging
+from datetime import datetime
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+
+log = logging.getLogger(__name__)
+
+
+VOID_TAGS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+def decodeContent(content):
+    if type(content) == str:
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            return content.decode('windows-1257', 'replace')
+    return content
+
+def getClasses(attrs):
+    for name, value in attrs:
+        if name == 'class' and value:
+            return value.split()
+    return []
+
+def getId(attrs):
+    for name, value in attrs:
+        if name == 'id':
+            return value
+
+
+##
+# Event driven HTML parser base keeping only open tags stack. Subclasses
+# collect text of interesting elements with capture()/release().
+##
+class StreamParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.stack = []
+        self.captures = []
+
+    def feedAll(self, content):
+        self.feed(decodeContent(content))
+        self.close()
+        # Elements left open are closed at the end of document
+        while self.stack:
+            opened = self.stack.pop()
+            self.endElement(opened, len(self.stack))
+
+    def capture(self, name):
+        self.captures.append([len(self.stack), name, []])
+
+    def release(self, depth):
+        # Called with stack depth of closing element, returns captured texts
+        released = []
+        while self.captures and self.captures[-1][0] >= depth:
+            _, name, texts = self.captures.pop()
+            released.append((name, u''.join(texts)))
+        return released
+
+    def handle_starttag(self, tag, attrs):
+        self.startElement(tag, attrs)
+        if tag in VOID_TAGS:
+            self.endElement(tag, len(self.stack))
+        else:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.startElement(tag, attrs)
+        self.endElement(tag, len(self.stack))
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while self.stack:
+            opened = self.stack.pop()
+            self.endElement(opened, len(self.stack))
+            if opened == tag:
+                break
+
+    def handle_data(self, data):
+        for capture in self.captures:
+            capture[2].append(data)
+        self.textElement(data)
+
+    def handle_comment(self, data):
+        # Comments are not text of elements, but still are sibling nodes
+        self.commentElement(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u'&%s' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name.startswith('x') or name.startswith('X'):
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data(u'&#%s;' % name)
+
+    def startElement(self, tag, attrs):
+        pass
+
+    def endElement(self, tag, depth):
+        pass
+
+    def textElement(self, data):
+        pass
+
+    def commentElement(self, data):
+        pass
+
+
+##
+# Items may nest, every open item collects spans and description of its
+# whole subtree and records keep item start order, same as soup select.
+##
+class ScheduleParser(StreamParser):
+
+    def __init__(self):
+        StreamParser.__init__(self)
+        self.today = datetime.now()
+        self.result = []
+        self.listDepth = None
+        self.listDone = False
+        self.channelDepth = None
+        self.channel = None
+        self.items = []
+
+    def startElement(self, tag, attrs):
+        depth = len(self.stack)
+        classes = getClasses(attrs)
+        self.__endSiblings()
+
+        if self.listDepth == None:
+            if not self.listDone and 'channel-list' in classes:
+                self.listDepth = depth
+            return
+
+        if self.channelDepth == None:
+            if 'channel' in classes:
+                self.channelDepth = depth
+                self.channel = {'header': None, 'records': []}
+            return
+
+        if tag == 'header' and self.channel['header'] == None:
+            self.channel['header'] = False
+            self.capture('header')
+
+        for item in self.items:
+            if tag == 'span':
+                item['spans'].append(None)
+                if len(item['spans']) <= 2:
+                    self.capture((item, len(item['spans']) - 1))
+            if 'description' in classes and item['description'] == None:
+                item['description'] = False
+                self.capture((item, 'description'))
+
+        if tag == 'div' and 'item' in classes:
+            # Record slot taken at start keeps outer item before nested one
+            self.items.append({'depth': depth, 'spans': [], 'sibling': None, 'description': None,
+                               'position': len(self.channel['records'])})
+            self.channel['records'].append(None)
+
+    def __endSiblings(self):
+        # Node following the first span ends on any next tag
+        for item in self.items:
+            if item['sibling'] == []:
+                item['sibling'] = None
+            elif type(item['sibling']) == list:
+                item['sibling'] = u''.join(item['sibling'])
+
+    def textElement(self, data):
+        for item in self.items:
+            if type(item['sibling']) == list:
+                item['sibling'].append(data)
+
+    def commentElement(self, data):
+        # Comment right after the first span is the sibling node itself
+        for item in self.items:
+            if item['sibling'] == []:
+                item['sibling'].append(data)
+        self.__endSiblings()
+
+    def endElement(self, tag, depth):
+        self.__endSiblings()
+
+        for name, text in self.release(depth):
+            if name == 'header':
+                self.channel['header'] = text
+                continue
+            item, field = name
+            if field == 'description':
+                item['description'] = text
+            else:
+                item['spans'][field] = text
+                if field == 0:
+                    item['sibling'] = []
+
+        if self.items and depth == self.items[-1]['depth']:
+            self.__endItem(self.items.pop())
+        elif depth == self.channelDepth:
+            self.__endChannel()
+            self.channelDepth = None
+            self.channel = None
+        elif depth == self.listDepth:
+            self.listDepth = None
+            self.listDone = True
+
+    def __endItem(self, item):
+        spans = item['spans']
+        if len(spans) == 0:
+            raise ValueError('Missing show time span')
+        if type(item['sibling']) != unicode:
+            raise ValueError('Missing show title text')
+        time = spans[0].strip()
+        name = item['sibling'].strip()
+        if not name and len(spans) > 1:
+            name = spans[1]
+        info = item['description']
+        info = info and info.strip() or u''
+        self.channel['records'][item['position']] = {
+            'time': time,
+            'title': name,
+            'description': info
+        }
+
+    def __endChannel(self):
+        if not self.channel['header']:
+            raise ValueError('Missing channel header')
+        date = re.search("(\d\d\-\d\d)", self.channel['header'].strip()).group(1)
+        date = "%s-%s" % (self.today.year, date,)
+        records = []
+        for record in self.channel['records']:
+            records.append({
+                'date': date,
+                'time': record['time'],
+                'title': record['title'],
+                'description': record['description']
+            })
+        self.result.append({
+            'date': date,
+            'shows': records
+        })
+
+
+class ChannelsParser(StreamParser):
+
+    def __init__(self):
+        StreamParser.__init__(self)
+        self.formDepth = None
+        self.script = None
+
+    def startElement(self, tag, attrs):
+        if self.script != None:
+            return
+        if self.formDepth == None:
+            if getId(attrs) == 'topsearch_form':
+                self.formDepth = len(self.stack)
+        elif tag == 'script':
+            self.script = False
+            self.capture('script')
+
+    def endElement(self, tag, depth):
+        for name, text in self.release(depth):
+            self.script = text
+        if depth == self.formDepth:
+            self.formDepth = None
+
+
+def parseSchedule(content):
+    parser = ScheduleParser()
+    parser.feedAll(content)
+    if parser.listDepth == None and not parser.listDone:
+        raise ValueError('Missing channel list')
+    return parser.result
+
+def parseChannels(content):
+    parser = ChannelsParser()
+    parser.feedAll(content)
+    if not parser.script:
+        raise ValueError('Missing channels script')
+    chmatch = re.search("(\[.*\])", parser.script)
+    return json.loads(chmatch.group(1))
@@ -3,10 +3,19 @@ import os
 import re
 import json
 import logging
-from datetime import datetime
-from bs4 import BeautifulSoup
-
-import web
+import threading
+import collections
+from datetime import datetime, timedelta
+
+# Parsing and network modules are imported on first harvest, cached
+# queries do not need them
+import config
+import history
+import metrics
+import search
+import schedule
+import storage
+from storage import readJson, writeJson
 
 log = logging.getLogger(__name__)
 
@@ -40,35 +49,34 @@ def fallbackEncoding(line):
         return char
     return "".join(map(mutate, line))
 
+def foldText(line):
+    return fallbackEncoding(line).lower()
+
 def reduceCharset(line):
     return line.lower().replace(' ', '-')
 
-def readJson(fileName):
-    try:
-        fp = open(fileName, 'r')
-        data = json.load(fp)
-        fp.close()
-        return data
-    except Exception as e:
-        log.debug('Failed read JSON: %s', fileName)
-        return
-
-def writeJson(fileName, data):
-    try:
-        fp = open(fileName, 'w')
-        json.dump(data, fp)
-        fp.close()
-        return True
-    except Exception as e:
-        log.warn('Failed read JSON: %s', fileName)
-        return False
-
 def ensureSoup(data):
     if type(data) == str:
+        from bs4 import BeautifulSoup
         return BeautifulSoup(data, 'html.parser')
     return data
 
-def parseChannels(content, quiet=True):
+PARSER_ENGINES = ('soup', 'stream')
+
+##
+# Raw schedule page into plain day records, None when page does not
+# parse. Runs in harvest pipeline parse processes.
+##
+def parseSchedulePage(data, engine='soup'):
+    if engine == 'stream':
+        content = data
+    else:
+        content = ensureSoup(data)
+    if not content:
+        return None
+    return parseSchedule(content, engine=engine)
+
+def parseChannels(content, quiet=True, engine='soup'):
     def doFixup(channels):
         if not channels or len(channels) == 0:
             return channels
@@ -92,17 +100,21 @@ def parseChannels(content, quiet=True):
         chjson = chmatch.group(1)
         return json.loads(chjson)
 
-    content = ensureSoup(content)
+    if engine == 'stream':
+        import streamparse
+        parse = streamparse.parseChannels
+    else:
+        parse = lambda content: doParse(ensureSoup(content))
     if quiet:
         try:
-            return doFixup(doParse(content))
+            return doFixup(parse(content))
         except Exception as e:
             log.warn('Failed channels parse: %s', e.message)
             return None
     else:
-        return doFixup(doParse(content))
+        return doFixup(parse(content))
 
-def parseSchedule(content, quiet=True):
+def parseSchedule(content, quiet=True, engine='soup'):
     def doParse(html):
         result = []
         today = datetime.now()
@@ -144,35 +156,142 @@ def parseSchedule(content, quiet=True):
 
         return result
 
-    content = ensureSoup(content)
+    if engine == 'stream':
+        import streamparse
+        parse = streamparse.parseSchedule
+    else:
+        parse = lambda content: doParse(ensureSoup(content))
     if quiet:
         try:
-            return doParse(content)
+            return parse(content)
         except Exception as e:
             log.warn('Failed schedule parse: %s', e.message)
             return None
     else:
-        return doParse(content)
+        return parse(content)
+
+class ChannelCatalog:
+
+    def __init__(self, channels, stamp=None):
+        self.channels = channels
+        self.stamp = stamp
+        self.byName = {}
+        self.byLabel = {}
+        self.byGroup = collections.OrderedDict()
+        self.channelsMap = collections.OrderedDict()
+        self.categoriesMap = collections.OrderedDict()
+        for channel in channels:
+            self.byName[channel['name']] = channel
+            self.byLabel[channel['label']] = channel
+            self.byGroup.setdefault(channel['group'], []).append(channel)
+            self.channelsMap[channel['name']] = channel['label']
+            self.categoriesMap[channel['group']] = channel['category']
+
+    def find(self, channel):
+        return self.byName.get(channel) or self.byLabel.get(channel)
+
+    def getGroup(self, group):
+        return self.byGroup.get(group, [])
+
+    ##
+    # Names of channels and channel groups resolved to channel names, all
+    # channels when none given. Unknown names are skipped.
+    ##
+    def resolve(self, names=None):
+        if not names:
+            return [channel['name'] for channel in self.channels]
+        channels = []
+        for name in names:
+            if name in self.byName:
+                channels.append(name)
+            else:
+                channels.extend(channel['name'] for channel in self.getGroup(name))
+        return channels
+
 
 class ChannelStore:
 
+    SITE_URL="http://www.tvprograma.lt"
     CHANNELS_URL="http://www.tvprograma.lt/"
     SCHEDULE_URL_SELF="http://www.tvprograma.lt/tv-programa/televizija/%s/%s"
     SCHEDULE_URL_DATE="http://www.tvprograma.lt/tv-programa/televizija/%s/%s/%s"
 
     def __init__(self, params):
         self.params = params
-        self.http = web.Http(self.params)
-
-    def __getChannelsCache(self):
-        return os.path.join(self.params.storage_dir, 'channels.json')
-
-    def __getScheduleCache(self, channel, date):
-        fileName = "%s-%s.json" % (channel, date.strftime("%Y%m%d"))
-        return os.path.join(self.params.storage_dir, fileName)
+        self.engine = self.params.parser_engine or 'soup'
+        self.storage = storage.getStorage(params)
+        # Stand-in site, eg. ./standin.py, serves pages under the same paths
+        siteUrl = (self.params.site_url or '').rstrip('/')
+        if siteUrl:
+            for name in ('CHANNELS_URL', 'SCHEDULE_URL_SELF', 'SCHEDULE_URL_DATE'):
+                setattr(self, name, getattr(self, name).replace(self.SITE_URL, siteUrl, 1))
+        self.index = None
+        # Parsed shows kept in memory by resident daemon, None disables it
+        self.showsCache = None
+        # Most days single schedule page was seen covering
+        self.pageSpan = 1
+        # Called with (channel, day, delta) when stored schedule changes,
+        # delta is None when not known, eg. schedule rewritten by other
+        # process or dropped from memory
+        self.listeners = []
+        self.local = threading.local()
+        self.catalog = None
+        self.catalogLock = threading.Lock()
+        self.indexLock = threading.Lock()
+        self.history = history.HistoryArchive(params)
+        self.expiredDay = None
+        self.expireLock = threading.Lock()
+
+    ##
+    # HTTP client per thread, each one keeps own last response for archiving
+    ##
+    def __getHttp(self):
+        http = getattr(self.local, 'http', None)
+        if not http:
+            import web
+            # Last page of thread is kept for archiving
+            http = web.Http(self.params)
+            self.local.http = http
+        return http
+
+    ##
+    # Stream engine parses raw page itself, soup tree is built once per page
+    ##
+    def __parsePage(self, data):
+        if self.engine == 'stream':
+            return data
+        with metrics.timer('parse.tree'):
+            return ensureSoup(data)
 
     def getChannelList(self):
         log.debug('getChannelList()')
+        catalog = self.getChannelCatalog()
+        if not catalog:
+            return None
+        return catalog.channels
+
+    ##
+    # Channels list is parsed once and reused until storage stamp changes
+    ##
+    def getChannelCatalog(self):
+        with self.catalogLock:
+            stamp = self.storage.getChannelListStamp()
+            if self.catalog and stamp != None and self.catalog.stamp == stamp:
+                return self.catalog
+
+            channels = self.__loadChannelList()
+            if channels == None:
+                return None
+
+            log.debug('Build channel catalog')
+            self.catalog = ChannelCatalog(channels, self.storage.getChannelListStamp())
+            return self.catalog
+
+    def refreshChannelCatalog(self):
+        with self.catalogLock:
+            self.catalog = None
+
+    def __loadChannelList(self):
         channels = self.readChannelList()
         # Explicitly check None because empty lists is negative result too
         if channels != None:
@@ -189,85 +308,311 @@ class ChannelStore:
 
     def getChannelSchedule(self, channel, date=None):
         log.debug('getChannelSchedule(): %s (%s)', channel, date)
-        schedule = self.readChannelSchedule(channel, date)
+        shows = self.readChannelSchedule(channel, date)
         # Explicitly check None because empty lists is negative result too
-        if schedule != None:
+        if shows != None:
             log.debug('Using cached channel schedule: %s (%s)', channel, date)
-            return schedule
+            return shows
 
         shedules = self.harvestChannelSchedule(channel, date)
         if not shedules or len(shedules) == 0:
             log.warn('Failed channel schedule harvest: %s', channel)
             return None
 
-        for schedule in shedules:
-            date = datetime.strptime(schedule['date'], "%Y-%m-%d")
-            shows = schedule['shows']
-            if not self.hasChannelSchedule(channel, date):
-                self.saveChannelSchedule(channel, date, shows)
-            else:
+        self.saveHarvest(channel, shedules)
+        return shedules[0]['shows']
+
+    def saveHarvest(self, channel, shedules):
+        with self.storage.batch():
+            for daySchedule in shedules:
+                date = datetime.strptime(daySchedule['date'], "%Y-%m-%d")
+                # Start/end minutes are resolved once at harvest
+                shows = schedule.normalizeShows(daySchedule['shows'])
                 self.updateChannelSchedule(channel, date, shows)
+        if len(shedules) > self.pageSpan:
+            self.pageSpan = len(shedules)
+        self.__expireDaily()
+
+    ##
+    # Plan schedule page fetches for missing channel dates. Page of date
+    # covers known page span days starting from it, so the earliest
+    # missing date is fetched and dates its page covers are skipped.
+    ##
+    def planChannelFetches(self, channel, dates):
+        pages = []
+        covered = None
+        for date in sorted(dates):
+            if covered != None and date < covered:
+                continue
+            if self.hasChannelSchedule(channel, date):
+                continue
+            pages.append(date)
+            covered = date + timedelta(days=self.pageSpan)
+        return pages
+
+    ##
+    # Harvest missing channel dates with as few page fetches as possible.
+    # Pages are fetched following plan, which is revised after every
+    # fetch with days the page actually contained. Returns fetches count.
+    ##
+    def fetchChannelDates(self, channel, dates):
+        pages = self.planChannelFetches(channel, dates)
+        log.debug('fetchChannelDates(): %s planned %s fetches for %s dates', channel, len(pages), len(dates))
+        fetches = 0
+        failed = set()
+        while len(pages) > 0:
+            date = pages[0]
+            fetches += 1
+            shedules = self.harvestChannelSchedule(channel, date)
+            if not shedules or len(shedules) == 0:
+                log.warn('Failed channel schedule harvest: %s (%s)', channel, date)
+            else:
+                self.saveHarvest(channel, shedules)
+            # Page might not contain requested date, do not retry it
+            failed.add(date)
+            pages = self.planChannelFetches(channel, filter(lambda date: date not in failed, dates))
+        return fetches
+
+    def getChannelShows(self, channel, date=None):
+        log.debug('getChannelShows(): %s (%s)', channel, date)
+        cached = self.showsCache != None and self.showsCache.get((channel, date))
+        if cached:
+            # Schedule might be rewritten by other process, eg. --prefetch
+            stamp, shows = cached
+            if stamp == self.storage.getScheduleStamp(channel, date):
+                metrics.count('shows.memo.hit')
+                return shows
+            metrics.count('shows.memo.stale')
+            self.__notifyChange(channel, date, None)
+
+        # Stamp is taken before read, so concurrent write is noticed later
+        stamp = self.showsCache != None and self.storage.getScheduleStamp(channel, date)
+        shows = self.getChannelSchedule(channel, date)
+        if shows == None:
+            return None
+        shows = schedule.makeShows(channel, date, shows)
+        if self.showsCache != None and date != None:
+            self.showsCache[(channel, date)] = (stamp, shows)
+        return shows
 
-        return shedules[0]['shows']
+    def enableShowsCache(self):
+        self.showsCache = {}
+        self.addScheduleListener(lambda channel, day, delta: self.showsCache.pop((channel, day), None))
+
+    def dropShowsCache(self, before=None):
+        if self.showsCache == None:
+            return
+        for channel, day in self.showsCache.keys():
+            if before == None or day < before:
+                self.__notifyChange(channel, day, None)
+
+    ##
+    # Past days missing in storage might be rolled up into history
+    ##
+    def __isPast(self, date):
+        day = isinstance(date, datetime) and date.date() or date
+        return day < datetime.now().date()
 
     def hasChannelSchedule(self, channel, date):
         log.debug('hasChannelSchedule(): %s (%s)', channel, date)
-        return os.path.isfile(self.__getScheduleCache(channel, date))
+        if self.storage.hasSchedule(channel, date):
+            return True
+        return self.__isPast(date) and self.history.hasSchedule(channel, date)
 
     def listChannelSchedules(self, channel):
         log.debug('listChannelSchedules(): %s', channel)
-        filesList = os.listdir(self.params.storage_dir)
-        filePattern = re.compile("^" + channel + "\-(\d+)\.json")
-        dates = []
-        for fileName in filesList:
-            match = filePattern.match(fileName)
-            if not match:
-                continue
-            matchDate = match.group(1)
-            log.debug('Found "%s" schedule at: %s', channel, matchDate)
-            dates.append(datetime.strptime(matchDate, '%Y%m%d').date())
-
-        return dates
+        return self.storage.listSchedules(channel)
 
     def readChannelSchedule(self, channel, date):
         log.debug('readChannelSchedule(): %s (%s)', channel, date)
-        return readJson(self.__getScheduleCache(channel, date))
+        with metrics.timer('store.read'):
+            shows = self.storage.readSchedule(channel, date)
+            if shows == None and self.__isPast(date):
+                shows = self.history.readSchedule(channel, date)
+        metrics.count(shows == None and 'store.miss' or 'store.hit')
+        return shows
+
+    ##
+    # Expire schedules older than STORAGE_DECAY days. With STORAGE_ROLLUP
+    # they are moved into monthly history bundles, which stay readable by
+    # date queries and search index, otherwise they are removed.
+    ##
+    def expireSchedules(self, days=None):
+        if not days:
+            days = config.getInt(self.params, 'storage_decay', 0)
+        if days <= 0:
+            log.debug('Schedules retention not configured')
+            return 0
+        rollup = config.getBool(self.params, 'storage_rollup', True)
+        before = datetime.now().date() - timedelta(days=days)
+
+        months = collections.OrderedDict()
+        for channel, day in self.storage.listAllSchedules():
+            if day < before:
+                months.setdefault((channel, day.strftime('%Y%m')), []).append(day)
+
+        index = not rollup and self.getShowIndex()
+        count = 0
+        for (channel, month), days in months.items():
+            if rollup:
+                schedules = {}
+                for day in days:
+                    shows = self.storage.readSchedule(channel, day)
+                    if shows != None:
+                        schedules[day] = shows
+                if not self.history.saveSchedules(channel, days[0], schedules):
+                    log.warn('Failed roll up %s schedules of %s', channel, month)
+                    continue
+            with self.storage.batch():
+                for day in days:
+                    self.storage.deleteSchedule(channel, day)
+                    if index:
+                        index.remove(channel, day)
+            count += len(days)
+
+        if count > 0:
+            self.dropShowsCache(before)
+        log.info('Expired %s schedules older than %s', count, before)
+        return count
+
+    ##
+    # Retention runs once a day along with harvests
+    ##
+    def __expireDaily(self):
+        today = datetime.now().strftime('%Y-%m-%d')
+        if self.expiredDay == today:
+            return
+        with self.expireLock:
+            if self.expiredDay == today:
+                return
+            self.expiredDay = today
+            if config.getInt(self.params, 'storage_decay', 0) <= 0:
+                return
+            stampFile = os.path.join(self.params.storage_dir, 'retention.json')
+            stamp = readJson(stampFile) or {}
+            if stamp.get('day') == today:
+                return
+            self.expireSchedules()
+            writeJson(stampFile, {'day': today})
 
     def saveChannelSchedule(self, channel, date, schedule):
         log.debug('writeChannelSchedule(): %s (%s)', channel, date)
-        return writeJson(self.__getScheduleCache(channel, date), schedule)
+        with metrics.timer('store.write'):
+            if not self.storage.saveSchedule(channel, date, schedule):
+                return False
+        index = self.getShowIndex()
+        if index:
+            with metrics.timer('index.update'):
+                index.update(channel, date, schedule)
+        return True
 
-    def harvestChannelSchedule(self, channel, date):
-        log.debug('harvestChannelSchedule(): %s (%s)', channel, date)
-        if self.params.local_only:
-            log.info('Found LOCAL_ONLY. Skipping harvest')
+    ##
+    # Search index database is opened on first use
+    ##
+    def getShowIndex(self):
+        if not config.getBool(self.params, 'search_index', True):
             return None
+        with self.indexLock:
+            if not self.index:
+                self.index = search.ShowIndex(self.params, foldText)
+            return self.index
+
+    ##
+    # Lookup shows by title/description words in search index, returns None
+    # when index can not answer and schedules have to be scanned instead.
+    # Index matches word prefixes only, nothing found is scanned too for
+    # mid-word substrings.
+    ##
+    def searchShows(self, pattern, channels=None, dates=None):
+        log.debug('searchShows(): %s', pattern)
+        index = self.getShowIndex()
+        if not index:
+            return None
+        if not index.isBuilt():
+            index.rebuild(self.storage, self.history)
+        with metrics.timer('index.search'):
+            found = index.search(pattern, channels, dates)
+        if not found:
+            return None
+        return found
 
-        channelsList = self.getChannelList()
+    def getScheduleUrl(self, channel, date):
+        catalog = self.getChannelCatalog()
+        channelData = catalog and catalog.find(channel)
         channelNumber = None
         channelName = None
-        for channelData in channelsList:
-            if channelData['name'] == channel or channelData['label'] == channel:
-                # XXX(edzius): It could be simply just channelData['link']..?
-                channelNumber = channelData['value']
-                channelName = channelData['name']
-                break
+        if channelData:
+            # XXX(edzius): It could be simply just channelData['link']..?
+            channelNumber = channelData['value']
+            channelName = channelData['name']
 
         if not channelName or not channelNumber:
             log.info('Missing channel metadata to start harvest')
-            return
+            return None
 
         log.info('Start channel schedule harvest "%s" (%s) date %s', channelName, channelNumber, date)
         if not date:
-            guideUrl = self.SCHEDULE_URL_SELF % (channelName, channelNumber,)
-        else:
-            guideUrl = self.SCHEDULE_URL_DATE % (channelName, channelNumber, date.strftime("%Y_%m_%d"),)
-        data = self.http.get(guideUrl)
+            return self.SCHEDULE_URL_SELF % (channelName, channelNumber,)
+        return self.SCHEDULE_URL_DATE % (channelName, channelNumber, date.strftime("%Y_%m_%d"),)
+
+    ##
+    # Download schedule page only, pipeline parses it elsewhere.
+    # Returns page URL and contents, contents None on failure.
+    ##
+    def fetchSchedulePage(self, channel, date):
+        guideUrl = self.getScheduleUrl(channel, date)
+        if not guideUrl:
+            return None, None
+        return guideUrl, self.__getHttp().get(guideUrl)
+
+    ##
+    # Harvest missing dates of many channels through harvest pipeline.
+    # Pages are planned per channel and planned again for dates the
+    # fetched pages did not cover, until a round adds nothing new.
+    ##
+    def harvestChannelsDates(self, channelDates, onStored=None):
+        import harvest
+        if config.getBool(self.params, 'local_only'):
+            log.info('Found LOCAL_ONLY. Skipping harvest')
+            return 0
+        pipeline = harvest.HarvestPipeline(self, config.getInt(self.params, 'workers', 1),
+                                           config.getInt(self.params, 'parse_processes', 0))
+        attempted = set()
+        fetches = 0
+        # Until some page showed days it covers, first page per channel only
+        learn = self.pageSpan == 1
+        while True:
+            pages = []
+            for channel, dates in channelDates.items():
+                dates = filter(lambda date: (channel, date) not in attempted, dates)
+                planned = self.planChannelFetches(channel, dates)
+                pages.extend((channel, date) for date in (learn and planned[:1] or planned))
+            learn = False
+            if len(pages) == 0:
+                break
+            # Page might not contain requested date, do not retry it
+            attempted.update(pages)
+            fetches += len(pages)
+            pipeline.run(pages, onStored)
+        return fetches
+
+    def harvestChannelSchedule(self, channel, date):
+        log.debug('harvestChannelSchedule(): %s (%s)', channel, date)
+        if config.getBool(self.params, 'local_only'):
+            log.info('Found LOCAL_ONLY. Skipping harvest')
+            return None
 
-        content = BeautifulSoup(data, 'html.parser')
+        guideUrl = self.getScheduleUrl(channel, date)
+        if not guideUrl:
+            return
+
+        http = self.__getHttp()
+        data = http.get(guideUrl)
+
+        content = self.__parsePage(data)
         if not content:
             log.error('Failed parse: %s', guideUrl)
-            self.http.archive()
+            http.archive('parse')
             return
 
         # Attempt update channel list
@@ -275,41 +620,44 @@ class ChannelStore:
             log.debug('Failed attempt to update channel list')
             pass
 
-        schedule = parseSchedule(content)
+        with metrics.timer('parse.schedule'):
+            schedule = parseSchedule(content, engine=self.engine)
         if not schedule:
             log.error('Failed capture: %s', guideUrl)
-            self.http.archive()
+            http.archive('capture schedule')
             return
 
         return schedule
 
     def readChannelList(self):
         log.debug('readChannelList()')
-        return readJson(self.__getChannelsCache())
+        return self.storage.readChannelList()
 
     def saveChannelList(self, channels):
         log.debug('saveChannelList()')
-        return writeJson(self.__getChannelsCache(), channels)
+        return self.storage.saveChannelList(channels)
 
     def harvestChannelList(self):
         log.debug('harvestChannelList()')
-        if self.params.local_only:
+        if config.getBool(self.params, 'local_only'):
             log.info('Found LOCAL_ONLY. Skipping harvest')
             return None
 
         log.info('Start channel list harvest')
-        data = self.http.get(self.CHANNELS_URL)
+        http = self.__getHttp()
+        data = http.get(self.CHANNELS_URL)
 
-        content = BeautifulSoup(data, 'html.parser')
+        content = self.__parsePage(data)
         if not content:
-            log.error('Failed parse: %s', url)
-            self.http.archive()
+            log.error('Failed parse: %s', self.CHANNELS_URL)
+            http.archive('parse')
             return
 
-        channels = parseChannels(content)
+        with metrics.timer('parse.channels'):
+            channels = parseChannels(content, engine=self.engine)
         if not channels:
-            log.error('Failed capture: %s', url)
-            self.http.archive()
+            log.error('Failed capture: %s', self.CHANNELS_URL)
+            http.archive('capture channels')
             return
 
         return channels
@@ -318,6 +666,41 @@ class ChannelStore:
         # TODO: Not required still
         return True
 
+    ##
+    # Merge harvested shows into stored day, storage is written only when
+    # shows actually changed. Returns shows delta, None on failure.
+    ##
     def updateChannelSchedule(self, channel, date, guide):
-        # TODO: Not required still
-        return True
+        log.debug('updateChannelSchedule(): %s (%s)', channel, date)
+        stored = self.readChannelSchedule(channel, date)
+        if stored == None:
+            if not self.saveChannelSchedule(channel, date, guide):
+                return None
+            delta = {'added': guide, 'changed': [], 'removed': []}
+            self.__notifyChange(channel, date, delta)
+            return delta
+
+        merged, delta = schedule.mergeShows(stored, guide)
+        if not schedule.isChanged(delta):
+            log.debug('Schedule not changed: %s (%s)', channel, date)
+            metrics.count('store.unchanged')
+            return delta
+
+        log.info('Schedule changed %s (%s): %s added, %s changed, %s removed', channel, date,
+                 len(delta['added']), len(delta['changed']), len(delta['removed']))
+        if not self.saveChannelSchedule(channel, date, merged):
+            return None
+        self.__notifyChange(channel, date, delta)
+        return delta
+
+    ##
+    # Listeners forget whatever they keep of changed schedule, eg. shows
+    # cache and interval indexes of daemon
+    ##
+    def addScheduleListener(self, listener):
+        self.listeners.append(listener)
+
+    def __notifyChange(self, channel, date, delta):
+        day = isinstance(date, datetime) and date.date() or date
+        for listener in self.listeners:
+            listener(channel, day, delta)
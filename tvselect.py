@@ -1,8 +1,14 @@
 
 import collections
 import datetime
+import heapq
 import logging
 
+import config
+import harvest
+import metrics
+import schedule
+
 log = logging.getLogger(__name__)
 
 
@@ -22,17 +28,17 @@ def getGroupsList(store, channels=None):
 
 def getChannelsMap(store):
     log.debug('getChannnelsMap()')
-    result = collections.OrderedDict()
-    for channel in store.getChannelList():
-        result[channel['name']] = channel['label']
-    return result
+    catalog = store.getChannelCatalog()
+    if not catalog:
+        return collections.OrderedDict()
+    return catalog.channelsMap
 
 def getCategoriesMap(store):
     log.debug('getCategoriesMap()')
-    result = collections.OrderedDict()
-    for channel in store.getChannelList():
-        result[channel['group']] = channel['category']
-    return result
+    catalog = store.getChannelCatalog()
+    if not catalog:
+        return collections.OrderedDict()
+    return catalog.categoriesMap
 
 def enlist(item):
     if type(item) == str:
@@ -62,39 +68,25 @@ class ShowSelect:
     def __init__(self, store, force=False):
         self.store = store
         self.force = force
-
-    def __listChannelNames(self, channels=None):
-        return getChannelsList(self.store, channels)
-
-    def __listChannelGroups(self, channels=None):
-        return getGroupsList(self.store, channels)
+        self.workers = config.getInt(store.params, 'workers', 1)
+        self.intervals = {}
+        store.addScheduleListener(self.__forgetIntervals)
 
     ##
     # Format channel names list according provided chName or chGroup
     ##
-    def __formatChannelList(self, channelsList, chName=None, chGroup=None):
-        if chName:
-            log.debug('__formatChannelList(): single channel filter %s', chName)
-            channelsAll = self.__listChannelNames(channelsList)
-            # TODO(edzius): add debug logging for filtered channels
-            channels = filter(lambda channel: channel in channelsAll, enlist(chName))
-        elif chGroup:
-            log.debug('__formatChannelList(): channel group filter %s', chGroup)
-            groupsAll = self.__listChannelGroups(channelsList)
-            # TODO(edzius): add debug logging for filtered channels. Otherwise this filter is redundant
-            groups = filter(lambda group: group in groupsAll, enlist(chGroup))
-            channels = self.__listChannelNames(filter(lambda channel: channel['group'] in groups, channelsList))
-            log.debug('__formatChannelList(): channel group found channels %s', channels)
-        else:
-            log.debug('__formatChannelList(): all channel filter')
-            channels = self.__listChannelNames(channelsList)
-
+    def __formatChannelList(self, catalog, chName=None, chGroup=None):
+        log.debug('__formatChannelList(): channel filter %s, group filter %s', chName, chGroup)
+        channels = catalog.resolve(enlist(chName) or enlist(chGroup))
+        log.debug('__formatChannelList(): found channels %s', channels)
         return channels
 
     ##
     # Format channels matrix according provided date or dateFrom and dateTo
     ##
     def __formatChannelTimetable(self, channelsList, date=None, dateFrom=None, dateTo=None):
+        # Level checked once, loops below run per channel and date
+        debug = log.isEnabledFor(logging.DEBUG)
         channelsMatrix = {}
         # FIXME(edzius): Channel names in list as IS. Fix to convert to std from.
         if date != None:
@@ -104,83 +96,210 @@ class ShowSelect:
             log.debug('__formatChannelTimetable(): range dates mapping %s - %s', dateFrom, dateTo)
             day = datetime.timedelta(days=1)
             while dateFrom <= dateTo:
-                log.debug('__formatChannelTimetable(): add range date mapping %s', dateFrom)
+                if debug:
+                    log.debug('__formatChannelTimetable(): add range date mapping %s', dateFrom)
                 channelsMatrix[dateFrom] = list(channelsList)
                 dateFrom += day
         else:
             log.debug('__formatChannelTimetable(): use cached channel dates')
             for channel in channelsList:
-                log.debug('__formatChannelTimetable(): lookuop channel schedules for %s', channel)
+                if debug:
+                    log.debug('__formatChannelTimetable(): lookuop channel schedules for %s', channel)
                 chSchedules = self.store.listChannelSchedules(channel)
                 for chDate in chSchedules:
-                    log.debug('__formatChannelTimetable(): include channel schedule %s for %s', chDate, channel)
+                    if debug:
+                        log.debug('__formatChannelTimetable(): include channel schedule %s for %s', chDate, channel)
                     if chDate not in channelsMatrix:
                         channelsMatrix[chDate] = []
                     channelsMatrix[chDate].append(channel)
 
         return channelsMatrix
 
+    def __formatMissingTimetable(self, channelsMatrix):
+        missingMatrix = {}
+        for date, channels in channelsMatrix.items():
+            missing = filter(lambda channel: not self.store.hasChannelSchedule(channel, date), channels)
+            if len(missing) > 0:
+                missingMatrix[date] = missing
+        return missingMatrix
+
+    ##
+    # Channel dates of timetable in channels order, dates sorted
+    ##
+    def __formatChannelDates(self, channelsMatrix):
+        channelDates = collections.OrderedDict()
+        for date in sorted(channelsMatrix.keys()):
+            for channel in channelsMatrix[date]:
+                channelDates.setdefault(channel, []).append(date)
+        return channelDates
+
+    ##
+    # Fetch schedules of timetable channels, one worker task per channel.
+    # Channel dates are kept in one task because single schedule page
+    # covers several days, missing ones are fetched by store fetch plan.
+    # Channel schedules are generated in channels order as they get ready.
+    ##
+    def __streamTimetable(self, channelDates):
+        # Parse processes pay off for many channels, shows are output after harvest
+        pipeline = len(channelDates) > 1 and config.getInt(self.store.params, 'parse_processes', 0) > 0
+        if pipeline and not config.getBool(self.store.params, 'local_only'):
+            self.store.harvestChannelsDates(channelDates)
+
+        def harvestChannel(channel):
+            dates = channelDates[channel]
+            if not pipeline and not config.getBool(self.store.params, 'local_only'):
+                self.store.fetchChannelDates(channel, dates)
+            schedules = {}
+            for date in dates:
+                if not self.store.hasChannelSchedule(channel, date):
+                    # Already attempted by fetch plan
+                    schedules[date] = None
+                    continue
+                schedules[date] = self.store.getChannelShows(channel, date)
+            return schedules
+
+        log.debug('__streamTimetable(): %s channels with %s workers', len(channelDates), self.workers)
+        pool = harvest.WorkerPool(self.workers)
+        channels = channelDates.keys()
+        for channel, schedules in zip(channels, pool.imap(harvestChannel, channels)):
+            yield channel, schedules or {}
+
+    def __harvestTimetable(self, channelsMatrix):
+        return dict(self.__streamTimetable(self.__formatChannelDates(channelsMatrix)))
+
+    def __forgetIntervals(self, channel, day, delta):
+        self.intervals.pop((day, channel), None)
+
+    ##
+    # Lookup channel shows matching time criteria in channel day interval
+    # index. Channels are streamed one by one, so each of them gets its own
+    # index sorted once, lookups of the same criteria are cached there.
+    ##
+    def __lookupIntervals(self, date, channel, shows, time=None, timeFrom=None, timeTo=None):
+        intervals = self.intervals.get((date, channel))
+        if not intervals:
+            intervals = schedule.IntervalIndex(shows)
+            self.intervals[(date, channel)] = intervals
+
+        if time != None:
+            return intervals.at(schedule.toMinutes(time))
+        return intervals.between(schedule.toMinutes(timeFrom), schedule.toMinutes(timeTo))
+
+    ##
+    # Filter Show records, time criteria are compared as day minutes
+    ##
     def __formatShowsList(self, channel, showsList, showName=None, time=None, timeFrom=None, timeTo=None):
-        log.debug('__formatShowsList(): %s showName=%s time=%s timeFrom=%s timeTo=%s', channel, showName, time, timeFrom, timeTo)
-        nowTime = datetime.datetime.now().time()
-        timeThis = None
-        timeNext = None
+        # Filter messages format show times, skip them unless debugging
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('__formatShowsList(): %s showName=%s time=%s timeFrom=%s timeTo=%s', channel, showName, time, timeFrom, timeTo)
+        minutes = schedule.toMinutes(time)
+        minutesFrom = schedule.toMinutes(timeFrom)
+        minutesTo = schedule.toMinutes(timeTo)
         shows = []
-        for i in range(len(showsList)):
-            show = showsList[i]
-            if showName and show['title'].find(showName) == -1 and show['description'].find(showName) == -1:
-                log.debug('FILTER: Not satisfied show title/description (%s/%s): %s', show['title'], show['description'], showName)
+        for show in showsList:
+            if showName and show.title.find(showName) == -1 and show.description.find(showName) == -1:
+                if debug:
+                    log.debug('FILTER: Not satisfied show title/description (%s/%s): %s', show.title, show.description, showName)
+                continue
+            if minutes != None and not show.isAiring(minutes):
+                if debug:
+                    log.debug('FILTER: Not satisfied show time (%s-%s): %s', show.time, show.ends, time)
+                continue
+            if (minutesFrom != None or minutesTo != None) and not show.overlaps(minutesFrom, minutesTo):
+                if debug:
+                    log.debug('FILTER: Not satisfied show time (%s-%s): %s-%s', show.time, show.ends, timeFrom, timeTo)
                 continue
 
-            if i+1 < len(showsList):
-                showNext = showsList[i+1]
-            else:
-                showNext = showsList[0]
-            # Optimization for date parsing
-            timeThis = timeNext or datetime.datetime.strptime(show['time'], '%H:%M').time()
-            timeNext = datetime.datetime.strptime(showNext['time'], "%H:%M").time()
-            if time != None:
-                if timeCompare(time, timeThis) < 0 or timeCompare(time, timeNext) >= 0:
-                    log.debug('FILTER: Not satisfied show time (%s-%s): %s', timeThis, timeNext, time)
-                    continue
-            if timeFrom != None:
-                if timeCompare(timeFrom, timeNext) > 0:
-                    log.debug('FILTER: Not satisfied show time (%s): more %s', timeNext, timeFrom)
-                    continue
-            if timeTo != None:
-                if timeCompare(timeTo, timeThis) < 0:
-                    log.debug('FILTER: Not satisfied show timeTo (%s): less %s', timeThis, timeTo)
-                    continue
-
-            show['live'] = (timeCompare(nowTime, timeThis) >= 0 and timeCompare(nowTime, timeNext) < 0)
-            show['ends'] = showNext['time']
-            show['channel'] = channel
             shows.append(show)
 
         return shows
 
     def select(self, chName=None, chGroup=None, showName=None, date=None, dateFrom=None, dateTo=None, time=None, timeFrom=None, timeTo=None):
-        log.debug('select(): chName=%s chGroup=%s showName=%s date=%s dateFrom=%s dateTo=%s time=%s timeFrom=%s timeTo=%s', 
-                  chName, chGroup, showName, date, dateFrom, dateTo, time, timeFrom, timeTo)
-        channelsList = self.store.getChannelList()
-        selectedChannels = self.__formatChannelList(channelsList, chName, chGroup)
+        return list(self.iterate(chName, chGroup, showName, date, dateFrom, dateTo, time, timeFrom, timeTo))
+
+    ##
+    # Generate shows matching criteria as soon as channel schedules are
+    # harvested, channel after channel. Ordered mode merges sorted channel
+    # streams by date and start time, which waits for all channels.
+    ##
+    def iterate(self, chName=None, chGroup=None, showName=None, date=None, dateFrom=None, dateTo=None, time=None, timeFrom=None, timeTo=None, ordered=False):
+        log.debug('iterate(): chName=%s chGroup=%s showName=%s date=%s dateFrom=%s dateTo=%s time=%s timeFrom=%s timeTo=%s ordered=%s',
+                  chName, chGroup, showName, date, dateFrom, dateTo, time, timeFrom, timeTo, ordered)
+        catalog = self.store.getChannelCatalog()
+        if not catalog:
+            log.warn('No channels list available')
+            return
+        selectedChannels = self.__formatChannelList(catalog, chName, chGroup)
         selectedTimetable = self.__formatChannelTimetable(selectedChannels, date, dateFrom, dateTo)
+        channelDates = self.__formatChannelDates(selectedTimetable)
 
-        selectedResult = []
-        for date, channels in selectedTimetable.items():
-            for channel in channels:
-                channelShows = self.store.getChannelSchedule(channel, date)
-                if not channelShows:
-                    log.info('No shows for channel %s', channel)
-                    continue
+        foundShows = None
+        if showName:
+            # Stored schedules are answered by search index, harvest only missing ones
+            self.__harvestTimetable(self.__formatMissingTimetable(selectedTimetable))
+            foundShows = self.store.searchShows(showName, set(selectedChannels), selectedTimetable.keys())
+        if foundShows == None:
+            channelSchedules = self.__streamTimetable(channelDates)
+        else:
+            channelSchedules = ((channel, None) for channel in channelDates)
 
-                selectedShows = self.__formatShowsList(channel, channelShows, showName, time, timeFrom, timeTo)
-                if len(selectedShows) == 0:
-                    log.debug('No criteria matchinf shows for channel %s', channel)
-                    continue
+        criteria = (foundShows, showName, time, timeFrom, timeTo)
+        streams = (self.__selectChannel(channel, channelDates[channel], schedules, *criteria)
+                   for channel, schedules in channelSchedules)
+        if ordered:
+            streams = [self.__sortKeys(index, stream) for index, stream in enumerate(streams)]
+            streams = [heapq.merge(*streams)]
+
+        selectedCount = 0
+        for stream in streams:
+            for key, show in stream:
+                selectedCount += 1
+                yield show
+
+        log.debug('Selected shows matching criteria: %s', selectedCount)
 
-                selectedResult.extend(selectedShows)
+    ##
+    # Channel index and sequence keep merge stable and never compare shows
+    ##
+    def __sortKeys(self, index, shows):
+        for sequence, (date, show) in enumerate(shows):
+            yield (date, show.start, index, sequence), show
 
-        log.debug('Selected shows matching criteria: %s', len(selectedResult))
+    ##
+    # Shows of channel day matching criteria, None when day has no shows
+    ##
+    def __filterChannelDay(self, channel, date, schedules, foundShows, timed, showName=None, time=None, timeFrom=None, timeTo=None):
+        if foundShows != None:
+            channelShows = foundShows.get((channel, date.strftime('%Y-%m-%d')))
+            if not channelShows:
+                return None
+            # Shows are already matched by search index
+            selectedShows = self.__formatShowsList(channel, channelShows, None, time, timeFrom, timeTo)
+        elif not schedules.get(date):
+            log.info('No shows for channel %s', channel)
+            return None
+        elif timed:
+            channelShows = self.__lookupIntervals(date, channel, schedules[date], time, timeFrom, timeTo)
+            if not channelShows:
+                return None
+            # Shows are already matched by interval index
+            selectedShows = self.__formatShowsList(channel, channelShows, showName)
+        else:
+            selectedShows = self.__formatShowsList(channel, schedules[date], showName, time, timeFrom, timeTo)
+        return selectedShows
+
+    def __selectChannel(self, channel, dates, schedules, foundShows, showName=None, time=None, timeFrom=None, timeTo=None):
+        # Interval index pays off only when reused, ie. shows kept in daemon
+        timed = (time != None or timeFrom != None or timeTo != None) and self.store.showsCache != None
+        for date in dates:
+            with metrics.timer('select.filter'):
+                selectedShows = self.__filterChannelDay(channel, date, schedules, foundShows, timed, showName, time, timeFrom, timeTo)
+            if selectedShows == None:
+                continue
+            if len(selectedShows) == 0:
+                log.debug('No criteria matchinf shows for channel %s', channel)
+                continue
 
-        return selectedResult
+            for show in selectedShows:
+                yield date, show
@@ -1,10 +1,18 @@
-
 import os
-import shutil
 import time
+import zlib
+import socket
+import httplib
+import tempfile
+import threading
+import urlparse
 from datetime import datetime
 import logging
 
+import config
+import httpcache
+import metrics
+
 log = logging.getLogger(__name__)
 
 
@@ -26,26 +34,235 @@ def download(url, destFile):
         log.info('Failed read contens: %s', e.strerror)
         return
 
+def decode(data, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate stream without zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+class ConnectionPool:
+
+    def __init__(self, size=4, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme, host):
+        key = (scheme, host)
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+
+        log.debug('Open new connection: %s://%s', scheme, host)
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def release(self, scheme, host, conn):
+        key = (scheme, host)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+class Response:
+
+    def __init__(self, status, headers, data):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+HTTP_HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'User-Agent': 'tvguide/1.0',
+}
+
+HTTP_CHUNK = 64 * 1024
+
+def request(pool, url, headers=None, redirects=5):
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    sendHeaders = dict(HTTP_HEADERS)
+    sendHeaders.update(headers or {})
+
+    conn, reused = pool.acquire(parts.scheme, parts.netloc)
+    try:
+        conn.request('GET', path, headers=sendHeaders)
+        resp = conn.getresponse()
+    except (socket.error, httplib.HTTPException) as e:
+        conn.close()
+        if not reused:
+            raise
+        # Kept alive connection may be already closed by server, retry once
+        log.debug('Stale connection to %s: %s', parts.netloc, e)
+        conn, reused = pool.acquire(parts.scheme, parts.netloc)
+        conn.request('GET', path, headers=sendHeaders)
+        resp = conn.getresponse()
+
+    chunks = []
+    while True:
+        chunk = resp.read(HTTP_CHUNK)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    data = decode(''.join(chunks), resp.getheader('content-encoding'))
+    responseHeaders = dict(resp.getheaders())
+
+    if resp.will_close:
+        conn.close()
+    else:
+        pool.release(parts.scheme, parts.netloc, conn)
+
+    if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+        location = urlparse.urljoin(url, resp.getheader('location'))
+        log.debug('Follow redirect: %s', location)
+        return request(pool, location, headers, redirects - 1)
+
+    return Response(resp.status, responseHeaders, data)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    ##
+    # Take one token, blocking until it is available. Tokens are reserved
+    # under the lock and slept outside of it, so concurrent callers queue
+    # up one interval apart instead of waking all at once.
+    ##
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = self.tokens < 0 and -self.tokens / self.rate or 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+HOST_BUCKETS = {}
+HOST_BUCKETS_LOCK = threading.Lock()
+
+def getHostBucket(host, delay, burst=1):
+    with HOST_BUCKETS_LOCK:
+        bucket = HOST_BUCKETS.get(host)
+        if not bucket:
+            log.debug('Create rate limit for host %s: %s seconds, burst %s', host, delay, burst)
+            bucket = TokenBucket(1.0 / delay, burst)
+            HOST_BUCKETS[host] = bucket
+        return bucket
+
+
+HTTP_POOL = None
+HTTP_POOL_LOCK = threading.Lock()
+
+def getConnectionPool(params):
+    global HTTP_POOL
+    with HTTP_POOL_LOCK:
+        if not HTTP_POOL:
+            HTTP_POOL = ConnectionPool(config.getInt(params, 'http_pool', 4),
+                                       config.getFloat(params, 'http_timeout', 30))
+        return HTTP_POOL
+
+
+HTTP_CACHE = None
+
+def getResponseCache(params):
+    global HTTP_CACHE
+    with HTTP_POOL_LOCK:
+        if not HTTP_CACHE:
+            HTTP_CACHE = httpcache.ResponseCache(os.path.join(params.cache_dir, 'http'),
+                                                 config.getInt(params, 'http_cache_ttl', 3600),
+                                                 config.getInt(params, 'http_cache_size', 64 * 1024 * 1024))
+        return HTTP_CACHE
+
+
+PAGE_ARCHIVE = None
+
+def getPageArchive(params):
+    global PAGE_ARCHIVE
+    with HTTP_POOL_LOCK:
+        if not PAGE_ARCHIVE:
+            import pagearchive
+            PAGE_ARCHIVE = pagearchive.PageArchive(params.archive_dir,
+                                                   config.getInt(params, 'archive_size', 32 * 1024 * 1024))
+        return PAGE_ARCHIVE
+
 
 class Http:
 
-    def __init__(self, params, cacheName=None):
+    def __init__(self, params):
         self.params = params
-        self.cacheName = cacheName or (self.params.exec_name + ".data")
-        self.cacheFile = os.path.join(self.params.cache_dir, self.cacheName)
+        self.backend = self.params.http_backend or 'native'
         self.date = None
+        self.url = None
+        self.data = None
+
+    def throttle(self, url):
+        delay = config.getFloat(self.params, 'delay')
+        if delay <= 0:
+            return
+
+        host = urlparse.urlparse(url).netloc
+        burst = config.getInt(self.params, 'burst', 1)
+        wait = getHostBucket(host, delay, burst).acquire()
+        if wait:
+            log.debug('Delayed receive %.2f seconds for host %s', wait, host)
 
     def get(self, url):
         # Store get date for archiving
         self.date = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.url = url
+        self.data = None
 
         log.debug('Receiveing page contents of URL: %s', url)
 
-        if self.params.delay:
-            log.debug('Delay receive %s seconds', self.params.delay)
-            time.sleep(self.params.delay)
+        cache = getResponseCache(self.params)
+        data, entry = cache.fresh(url)
+        if data:
+            self.data = data
+            return data
+
+        with metrics.timer('http.throttle'):
+            self.throttle(url)
 
-        data = download(url, self.cacheFile)
+        with metrics.timer('http.download'):
+            if self.backend == 'wget':
+                data = self.getWget(url)
+                if data:
+                    cache.missed(url, data, {})
+            else:
+                data = self.getNative(url, cache, entry)
+        self.data = data
         if not data:
             log.error('Failed download: "%s"', url)
             return
@@ -54,16 +271,33 @@ class Http:
 
         return data
 
-    def archive(self):
-        log.debug('Archiving cache for inspection, date %s', self.date)
-        if not os.path.exists(self.params.archive_dir):
-            os.mkdir(self.params.archive_dir)
+    def getNative(self, url, cache, entry=None):
+        headers = entry and entry.validators() or {}
+        try:
+            response = request(getConnectionPool(self.params), url, headers)
+        except (socket.error, httplib.HTTPException, zlib.error) as e:
+            log.info('Failed request: %s', e)
+            return
+
+        if response.status == 304 and entry:
+            return cache.revalidated(entry)
+
+        if response.status != 200:
+            log.info('Failed request, status: %s', response.status)
+            return
+
+        cache.missed(url, response.data, response.headers)
+        return response.data
 
-        archiveName = "%s-%s" % (self.date, self.cacheName,)
-        archivePath = os.path.join(self.params.archive_dir, archiveName)
+    def getWget(self, url):
+        # Separate file for each request allows parallel downloads
+        fd, cacheFile = tempfile.mkstemp(suffix='.data', prefix=self.params.exec_name + '-', dir=self.params.cache_dir)
+        os.close(fd)
         try:
-            shutil.copyfile(self.cacheFile, archivePath)
-        except IOError as e:
-            log.warn("archive failed: %s", e.strerror)
+            return download(url, cacheFile)
+        finally:
+            os.remove(cacheFile)
 
-        log.info('Cache archived for inspection in: %s', archiveName)
+    def archive(self, error=None):
+        log.debug('Archiving page for inspection, date %s', self.date)
+        getPageArchive(self.params).store(self.url, self.data, error)